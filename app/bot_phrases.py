@@ -178,6 +178,24 @@ only_one_point = [
     'Изменение баллов на большее количество доступно только менеджерам. Для обычных пользователей доступен шаг в 1 балл.',
 ]
 
+export_not_allowed = [
+    'Выгрузить историю могут только администраторы и менеджеры чата.',
+    'Экспорт доступен только администраторам и менеджерам.',
+    'Историю чата выгружают только менеджеры и администраторы.',
+]
+
+export_started = [
+    'Собираю историю Е-баллов, пришлю файлом.',
+    'Выгрузка началась, файл скоро будет.',
+    'Готовлю файл с историей, подождите немного.',
+]
+
+export_empty = [
+    'В этом чате ещё никому не начисляли Е-баллы, выгружать нечего.',
+    'История пуста, выгружать нечего.',
+    'Начислений в чате пока не было.',
+]
+
 self_mentions = [
     "Хитрожопость зафиксирована @$nickname$ хотел изменить баллы сам себе! Ха-ха-ха!",
     "Не тут-то было, @$nickname$! Нельзя менять свои баллы!",
@@ -216,6 +234,18 @@ def get_clear_chat_message():
     return random.choice(clear_chat)
 
 
+def get_export_not_allowed_message():
+    return random.choice(export_not_allowed)
+
+
+def get_export_started_message():
+    return random.choice(export_started)
+
+
+def get_export_empty_message():
+    return random.choice(export_empty)
+
+
 def get_user_no_chats_message():
     return random.choice(no_chats)
 
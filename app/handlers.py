@@ -0,0 +1,278 @@
+from lib.crud import add_user, apply_vote, add_chat, check_user_exist_by_telegram_user_id, \
+    get_user_id_from_username, clear_chat_score, get_chat_ranking, get_user_messages_page, get_all_user_messages, check_chat_exist, \
+    can_manage_chat
+from app.bot_phrases import get_user_not_found_message, get_user_odd_point_message, get_user_add_point_message, \
+    get_user_hello_message, get_user_no_chats_message, get_allowed_only_in_private_chat_message, \
+    get_only_one_point_message, get_export_not_allowed_message, get_export_started_message
+from telebot.types import BotCommand
+import re
+from lib.keyboard import get_settings_keyboard_markup, bot_keyboard_buttons_handler, maybe_change_points, \
+    get_history_keyboard_markup
+from lib.state import awaiting_count_of_point
+from lib.errors import log_error
+from lib.functions import send_response, handle_points_update, sort_users, can_modify_points, parse_vote, \
+    parse_reply_vote, send_self_mention_message, send_long_message, send_reply, send_chat_message
+from lib.classes.OutboundScheduler import PRIORITY_INTERACTIVE, PRIORITY_FLAVOR
+from lib.classes.ChatAdminCache import chat_admins
+from lib.cache import can_manage_cache
+from lib.classes.ChatExporter import chat_exporter, EXPORT_FORMATS
+from lib.metrics import observe_handler
+
+# Определяем команды
+commands = [
+    BotCommand(command="/help", description="Помощь по командам"),
+    BotCommand(command="/clear_score", description="Сбросить счёт Е-баллов"),
+    BotCommand(command="/top", description="Топ пользователей по счёту (/top season=N - прошлый сезон)"),
+    BotCommand(command="/get_user_score", description="Счёт пользователя"),
+    BotCommand(command="/export", description="Выгрузить историю чата (/export jsonl - в JSONL)"),
+    BotCommand(command='/settings', description="Настроить группы (только в лс)")
+]
+
+# Типы апдейтов, которые запрашиваем у Telegram. chat_member не приходит, если его не указать явно
+allowed_updates = ['message', 'callback_query', 'chat_member']
+
+
+def callback_query(call, bot):
+    bot_keyboard_buttons_handler(call, bot)
+
+
+def on_new_chat_member(message, bot):
+    for new_member in message.new_chat_members:
+        # Проверяем, что добавлен именно бот
+        if new_member.id == bot.get_me().id:
+            message_text = get_user_hello_message()
+            send_chat_message(bot, message.chat.id, message_text, PRIORITY_FLAVOR)
+            if (not check_chat_exist(message.chat.id)):
+                add_chat(message.chat.id, message.chat.title)
+        elif (not check_user_exist_by_telegram_user_id(message.chat.id, new_member.id)):
+            username = new_member.username
+            if username:
+                add_user(new_member.id, message.chat.id, username, 0)
+
+
+def on_chat_member_updated(chat_member_updated, bot):
+    # Назначение и снятие администраторов сразу отражаем в кэше
+    chat_admins.apply_member_update(chat_member_updated)
+    can_manage_cache.delete((str(chat_member_updated.chat.id), str(chat_member_updated.new_chat_member.user.id)))
+
+
+def help_command(message, bot):
+    send_reply(bot, message, "Список команд:\n"
+                             "/help - вывести список команд\n"
+                             "/clear_score - очищает счёт всех пользователей\n"
+                             "/top - выводит топ 10 пользователей по E-баллам, /top season=N - топ прошлого сезона\n"
+                             "/get_user_score - посмотреть счёт пользователя и историю его пополнения\n"
+                             "/export - выгрузить историю Е-баллов чата файлом CSV, /export jsonl - в JSONL (для менеджеров)\n"
+                             "/settings - Настройки бота и отправка кармы, работает только в личных сообщениях\n\n\n"
+                             "По всем вопросам, багам и предложением: @Ra3Valik", PRIORITY_INTERACTIVE)
+
+
+def start_message(message, bot):
+    chat_type = message.chat.type
+
+    if chat_type == 'private':
+        markup = get_settings_keyboard_markup()
+        if markup:
+            send_chat_message(bot, message.chat.id, "Выберите кнопку:", reply_markup=markup)
+        else:
+            send_chat_message(bot, message.chat.id, get_user_no_chats_message())
+    else:
+        send_chat_message(bot, message.chat.id, get_allowed_only_in_private_chat_message())
+
+
+def handle_clear_score(message, bot):
+    chat_id = str(message.chat.id)
+    result = clear_chat_score(chat_id)
+    send_reply(bot, message, result, PRIORITY_INTERACTIVE)
+
+
+def handle_get_ranking(message, bot):
+    chat_id = str(message.chat.id)
+    # Формат: /top или /top season=3 для прошлого сезона
+    match = re.search(r"season=(\d+)", message.text or '')
+    result = get_chat_ranking(chat_id, int(match.group(1)) if match else None)
+    send_reply(bot, message, result, PRIORITY_INTERACTIVE)
+
+
+def handle_get_user_score(message, bot):
+    chat_id = str(message.chat.id)
+    # Считываем текст сообщения после команды
+    # Формат: /get_user_messages @username
+    try:
+        parts = message.text.split(maxsplit=1)
+        if len(parts) > 1:
+            mention = parts[1].strip()
+            match = re.match(r"@(\w+)", mention)
+            if not match:
+                username = message.from_user.username
+            else:
+                username = match.group(1)
+        else:
+            username = message.from_user.username
+
+        user_id = get_user_id_from_username(chat_id, username)
+        if user_id:
+            # Только первая страница истории, дальше листаем кнопками
+            result, newer_cursor, older_cursor = get_user_messages_page(chat_id, user_id)
+            send_reply(bot, message, result, PRIORITY_INTERACTIVE,
+                       reply_markup=get_history_keyboard_markup(user_id, newer_cursor, older_cursor))
+        else:
+            send_reply(bot, message, get_user_not_found_message(username), PRIORITY_INTERACTIVE)
+    except Exception as e:
+        log_error(f"handle_get_user_score {str(e)}")
+
+
+def handle_export(message, bot):
+    # Формат: /export или /export jsonl
+    parts = message.text.split(maxsplit=1)
+    export_format = parts[1].strip().lower() if len(parts) > 1 else 'csv'
+    if export_format not in EXPORT_FORMATS:
+        export_format = 'csv'
+
+    if not can_manage_chat(message.chat.id, message.from_user.id, bot):
+        send_reply(bot, message, get_export_not_allowed_message(), PRIORITY_INTERACTIVE)
+        return
+
+    send_reply(bot, message, get_export_started_message(), PRIORITY_INTERACTIVE)
+    # Выгрузка идёт в фоне, следующие апдейты чата её не ждут
+    chat_exporter.submit(bot, message.chat.id, message.message_id, export_format)
+
+
+# Команда для вывода всех сообщений пользователя
+# @bot.message_handler(commands=['get_user_score_history'])
+# def handle_get_user_score_history(message):
+#     chat_id = str(message.chat.id)
+#     # Считываем текст сообщения после команды
+#     # Формат: /get_all_user_messages @username
+#     try:
+#         parts = message.text.split(maxsplit=1)
+#         if len(parts) > 1:
+#             mention = parts[1].strip()
+#             match = re.match(r"@(\w+)", mention)
+#             if not match:
+#                 username = message.from_user.username
+#             else:
+#                 username = match.group(1)
+#         else:
+#             username = message.from_user.username
+#
+#         user_id = get_user_id_from_username(chat_id, username)
+#         if user_id:
+#             result = get_all_user_messages(chat_id, user_id)
+#             send_long_message(bot, message, result)
+#         else:
+#             bot.reply_to(message, get_user_not_found_message(username))
+#     except Exception as e:
+#         log_error(f"handle_get_user_score_history {str(e)}")
+
+
+# Обработчик всех сообщений
+def handle_message(message, bot):
+    chat_id = message.chat.id
+    telegram_user_id = message.from_user.id
+    chat_type = message.chat.type
+
+    # Если это личные сообщения и мы ожидаем кол-во для изменения баллов
+    if chat_type == 'private':
+        if awaiting_count_of_point.get(telegram_user_id):
+            user_id = awaiting_count_of_point.get(telegram_user_id)
+            del awaiting_count_of_point[telegram_user_id]
+            maybe_change_points(message, user_id, bot)
+        return
+
+    # Проверяем автора сообщения на наличие его в базе
+    if not check_user_exist_by_telegram_user_id(chat_id, telegram_user_id):
+        username = message.from_user.username
+        if username and message.from_user.is_bot == False:
+            add_user(telegram_user_id, chat_id, username, 0)
+
+    # ДРУГАЯ ОБРАБОТКА
+    # Если в сообщении есть упоминание со знаком баллов, то кто-то пытается баллы изменить
+    vote = parse_vote(message.text, message.entities)
+    if vote:
+        # Проверка прав пользователя на изменение больше чем на 1 балл
+        if not can_modify_points(chat_id, telegram_user_id, vote.delta, bot):
+            send_reply(bot, message, get_only_one_point_message())
+            return
+
+        # Отделение самозванцев от остальных упомянутых пользователей
+        mentioned_users, self_mention = sort_users(vote.usernames, message.from_user.username)
+        text_mentions = []
+        for text_mention in vote.text_mentions:
+            if text_mention[0] == telegram_user_id:
+                self_mention = self_mention or text_mention[1]
+            elif text_mention not in text_mentions:
+                text_mentions.append(text_mention)
+
+        # Обновление баллов и разделение пользователей на существующих и несуществующих
+        founded_user, not_founded_user = handle_points_update(chat_id, mentioned_users, vote.delta, vote.comment,
+                                                              message.from_user.username, text_mentions)
+
+        # Отправка одного ответа со всеми результатами, включая самозванцев
+        send_response(bot, message, founded_user, not_founded_user, vote.delta, self_mention)
+        return # Прерываем дальнейшую обработку, так как это сообщение уже обработано
+
+    # Упоминание без изменения баллов - обычное сообщение
+    if '@' in message.text:
+        return
+
+    # ДРУГАЯ ОБРАБОТКА
+    # Если сообщение является ответом на другое сообщение
+    if message.reply_to_message and message.reply_to_message.from_user.is_bot == False:
+        # Извлечение значения баллов из первого слова сообщения
+        vote = parse_reply_vote(message.text)
+        if vote:
+            reply_points, reply_message_text = vote.delta, vote.comment
+
+            # Получаем ID пользователя, на чьё сообщение ответили
+            target_user_id = message.reply_to_message.from_user.id
+            target_username = message.reply_to_message.from_user.username
+
+            # Проверка на самозванца
+            if target_user_id == telegram_user_id:
+                send_self_mention_message(bot, message, target_username)
+                return
+
+            # Проверка прав пользователя на изменение больше чем на 1 балл
+            if not can_modify_points(chat_id, telegram_user_id, reply_points, bot):
+                send_reply(bot, message, get_only_one_point_message())
+                return
+
+            # Обновление баллов и добавление сообщения в историю
+            apply_vote(chat_id, reply_points, reply_message_text, message.from_user.username,
+                       telegram_user_ids=[target_user_id])
+
+            # Отправка соответствующего сообщения
+            if reply_points > 0:
+                send_reply(bot, message, get_user_add_point_message([target_username], reply_points))
+            elif reply_points < 0:
+                send_reply(bot, message, get_user_odd_point_message([target_username], reply_points))
+
+            return
+
+
+def register_handlers(bot, wrap=None):
+    """
+    Регистрирует обработчики на боте. Порядок регистрации важен: telebot берёт первый подходящий обработчик
+
+    :param bot: TeleBot или AsyncTeleBot
+    :param wrap: Обёртка обработчика для асинхронного режима, без неё бот передаётся через pass_bot
+    :return:
+    """
+    def prepare(handler):
+        # Время обработчика и его запросы к БД попадают в метрики под его именем
+        handler = observe_handler(handler)
+        return wrap(handler) if wrap else handler
+
+    pass_bot = wrap is None
+
+    bot.register_callback_query_handler(prepare(callback_query), func=lambda call: True, pass_bot=pass_bot)
+    bot.register_message_handler(prepare(on_new_chat_member), content_types=['new_chat_members'], pass_bot=pass_bot)
+    bot.register_chat_member_handler(prepare(on_chat_member_updated), pass_bot=pass_bot)
+    bot.register_message_handler(prepare(help_command), commands=['help'], pass_bot=pass_bot)
+    bot.register_message_handler(prepare(start_message), commands=['settings'], pass_bot=pass_bot)
+    bot.register_message_handler(prepare(handle_clear_score), commands=['clear_score'], pass_bot=pass_bot)
+    bot.register_message_handler(prepare(handle_get_ranking), commands=['top'], pass_bot=pass_bot)
+    bot.register_message_handler(prepare(handle_get_user_score), commands=['get_user_score'], pass_bot=pass_bot)
+    bot.register_message_handler(prepare(handle_export), commands=['export'], pass_bot=pass_bot)
+    bot.register_message_handler(prepare(handle_message), func=lambda message: True, pass_bot=pass_bot)
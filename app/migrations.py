@@ -0,0 +1,204 @@
+from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, Text,
+                        UniqueConstraint, func, case, select, update, insert, bindparam, literal, table, column)
+from lib.migrator import create_index_if_missing, add_column_if_missing, drop_index_if_exists
+
+# Миграции не зависят от app/models.py: схема каждой миграции описана здесь такой, какой она была
+# в момент её появления, и дальше не меняется. Изменения моделей - только новыми миграциями
+metadata = MetaData()
+
+# Username без учёта регистра: collation по умолчанию в MySQL, NOCASE в sqlite
+Username = String(255).with_variant(String(255, collation='NOCASE'), 'sqlite')
+
+# Исходная схема (миграция 1)
+users = Table(
+    'users', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('telegram_user_id', String(255), nullable=False),
+    Column('chat_id', String(255), nullable=False),
+    Column('is_manager', Boolean, default=False),
+    Column('username', Username, nullable=False),
+    Column('score', Integer, default=0),
+    UniqueConstraint('telegram_user_id', 'chat_id', name='unique_user_chat'),
+)
+
+chats = Table(
+    'chats', metadata,
+    Column('chat_id', String(255), primary_key=True),
+    Column('chat_name', String(255), nullable=True),
+    Column('send_few_carma', String(255), nullable=False, default='all'),
+    Column('created_at', DateTime, server_default=func.now()),
+    Column('updated_at', DateTime, server_default=func.now(), onupdate=func.now()),
+    Column('last_reset', DateTime, nullable=True),
+)
+
+messages = Table(
+    'messages', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('points', Integer, nullable=False),
+    Column('message', Text, nullable=True),
+    Column('from_username', String(255), nullable=False),
+    Column('created_at', DateTime, server_default=func.now()),
+    Column('updated_at', DateTime, server_default=func.now(), onupdate=func.now()),
+)
+
+# Счёт по сезонам (миграция 4)
+user_scores = Table(
+    'user_scores', metadata,
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True, autoincrement=False),
+    Column('epoch', Integer, primary_key=True, autoincrement=False),
+    Column('chat_id', String(255), nullable=False),
+    Column('score', Integer, nullable=False, default=0, server_default='0'),
+    Column('added', Integer, nullable=False, default=0, server_default='0'),
+    Column('subtracted', Integer, nullable=False, default=0, server_default='0'),
+    Index('ix_user_scores_chat_epoch_score', 'chat_id', 'epoch', 'score'),
+)
+
+# Колонки, добавленные миграциями 3 и 4, для запросов к данным
+users_since_reset = table('users', column('id'), column('chat_id'), column('score'), column('added_since_reset'),
+                          column('subtracted_since_reset'))
+chats_epoch = table('chats', column('chat_id'), column('last_reset'), column('epoch'))
+messages_epoch = table('messages', column('user_id'), column('points'), column('created_at'), column('epoch'))
+
+
+def index_on(table_name, index_name, *column_names):
+    """
+    Индекс для create_index_if_missing по именам колонок, без привязки к таблицам выше
+
+    :param table_name:
+    :param index_name:
+    :param column_names:
+    :return: sqlalchemy Index
+    """
+    index_table = Table(table_name, MetaData(), *(Column(column_name) for column_name in column_names))
+    return Index(index_name, *(index_table.c[column_name] for column_name in column_names))
+
+
+def migration_initial(connection):
+    """
+    Исходная схема (то, что раньше создавал create_all при импорте моделей)
+    """
+    for baseline_table in (users, chats, messages):
+        baseline_table.create(connection, checkfirst=True)
+
+
+def migration_hot_query_indexes(connection):
+    """
+    Индексы для поиска пользователя по (chat_id, username) и истории по (user_id, created_at)
+    """
+    create_index_if_missing(connection, index_on('users', 'ix_users_chat_username', 'chat_id', 'username'))
+    create_index_if_missing(connection, index_on('messages', 'ix_messages_user_created', 'user_id', 'created_at'))
+
+
+def rebuild_since_reset_counters(connection):
+    """
+    Заполняет счётчики добавленных/отнятых с последней очистки баллов по таблице messages
+    """
+    chats_query = select(users_since_reset.c.chat_id, chats.c.last_reset).select_from(
+        users_since_reset.outerjoin(chats, chats.c.chat_id == users_since_reset.c.chat_id)).distinct()
+    set_counters = update(users_since_reset).where(users_since_reset.c.id == bindparam('user_id')).values(
+        added_since_reset=bindparam('added'), subtracted_since_reset=bindparam('subtracted'))
+
+    for current_chat_id, last_reset in connection.execute(chats_query).all():
+        totals_query = select(
+            messages.c.user_id,
+            func.sum(case((messages.c.points > 0, messages.c.points), else_=0)),
+            func.sum(case((messages.c.points < 0, messages.c.points), else_=0)),
+        ).join(users_since_reset, users_since_reset.c.id == messages.c.user_id) \
+            .where(users_since_reset.c.chat_id == current_chat_id)
+        if last_reset:
+            totals_query = totals_query.where(messages.c.created_at > last_reset)
+
+        totals = [
+            {'user_id': user_id, 'added': added or 0, 'subtracted': subtracted or 0}
+            for user_id, added, subtracted in connection.execute(totals_query.group_by(messages.c.user_id))
+        ]
+        if totals:
+            connection.execute(set_counters, totals)
+
+
+def migration_since_reset_counters(connection):
+    """
+    Счётчики добавленных/отнятых с последней очистки баллов и индекс для топа.
+    Счётчики сразу заполняются по истории сообщений
+    """
+    add_column_if_missing(connection, 'users', 'added_since_reset', 'INTEGER NOT NULL DEFAULT 0')
+    add_column_if_missing(connection, 'users', 'subtracted_since_reset', 'INTEGER NOT NULL DEFAULT 0')
+    create_index_if_missing(connection, index_on('users', 'ix_users_chat_score', 'chat_id', 'score'))
+    rebuild_since_reset_counters(connection)
+
+
+def rebuild_season_scores(connection, chat_id, epoch):
+    """
+    Счёт сезона чата по истории сообщений
+
+    :param connection:
+    :param chat_id:
+    :param epoch:
+    :return:
+    """
+    totals_query = select(
+        messages_epoch.c.user_id,
+        messages_epoch.c.epoch,
+        users.c.chat_id,
+        func.sum(messages_epoch.c.points),
+        func.sum(case((messages_epoch.c.points > 0, messages_epoch.c.points), else_=0)),
+        func.sum(case((messages_epoch.c.points < 0, messages_epoch.c.points), else_=0)),
+    ).join(users, users.c.id == messages_epoch.c.user_id) \
+        .where(users.c.chat_id == chat_id, messages_epoch.c.epoch == epoch) \
+        .group_by(messages_epoch.c.user_id, messages_epoch.c.epoch, users.c.chat_id)
+
+    connection.execute(user_scores.delete().where(user_scores.c.chat_id == chat_id, user_scores.c.epoch == epoch))
+    connection.execute(insert(user_scores).from_select(
+        ['user_id', 'epoch', 'chat_id', 'score', 'added', 'subtracted'], totals_query))
+
+
+def migration_chat_epochs(connection):
+    """
+    Сезоны вместо обнуления счёта: chats.epoch, messages.epoch и счёт по (пользователь, сезон) в user_scores.
+    Сообщения до последней очистки становятся сезоном 1, после неё - сезоном 2.
+    Текущий сезон берёт счёт из users, прошлый считается по истории
+    """
+    add_column_if_missing(connection, 'chats', 'epoch', 'INTEGER NOT NULL DEFAULT 1')
+    add_column_if_missing(connection, 'messages', 'epoch', 'INTEGER NOT NULL DEFAULT 1')
+    user_scores.create(connection, checkfirst=True)
+    create_index_if_missing(connection, index_on('messages', 'ix_messages_user_epoch_created',
+                                                 'user_id', 'epoch', 'created_at'))
+
+    reset_chats = connection.execute(select(chats.c.chat_id, chats.c.last_reset).where(
+        chats.c.last_reset.is_not(None))).all()
+    for chat_id, last_reset in reset_chats:
+        connection.execute(update(chats_epoch).where(chats_epoch.c.chat_id == chat_id).values(epoch=2))
+        connection.execute(update(messages_epoch).where(
+            messages_epoch.c.user_id.in_(select(users.c.id).where(users.c.chat_id == chat_id)),
+            messages_epoch.c.created_at > last_reset).values(epoch=2))
+        rebuild_season_scores(connection, chat_id, epoch=1)
+
+    # Текущий сезон: счёт из users, в чатах без записи в chats сезон первый
+    connection.execute(user_scores.delete().where(
+        user_scores.c.epoch == func.coalesce(
+            select(chats_epoch.c.epoch).where(chats_epoch.c.chat_id == user_scores.c.chat_id).scalar_subquery(), 1)))
+    connection.execute(insert(user_scores).from_select(
+        ['user_id', 'epoch', 'chat_id', 'score', 'added', 'subtracted'],
+        select(users_since_reset.c.id, func.coalesce(chats_epoch.c.epoch, literal(1)), users_since_reset.c.chat_id,
+               func.coalesce(users_since_reset.c.score, 0), users_since_reset.c.added_since_reset,
+               users_since_reset.c.subtracted_since_reset)
+        .select_from(users_since_reset.outerjoin(chats_epoch, chats_epoch.c.chat_id == users_since_reset.c.chat_id))))
+
+
+def migration_drop_users_score_index(connection):
+    """
+    Индекс топа по users.score не нужен с переходом на user_scores, а обновлялся при каждой записи в users.
+    Сами колонки остаются для отката
+    """
+    drop_index_if_exists(connection, 'users', 'ix_users_chat_score')
+
+
+# (номер, название, функция). Номера только растут, применённые миграции не меняем
+migrations = [
+    (1, 'initial', migration_initial),
+    (2, 'hot_query_indexes', migration_hot_query_indexes),
+    (3, 'since_reset_counters', migration_since_reset_counters),
+    (4, 'chat_epochs', migration_chat_epochs),
+    (5, 'drop_users_score_index', migration_drop_users_score_index),
+]
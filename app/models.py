@@ -1,11 +1,15 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, UniqueConstraint, Boolean, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, UniqueConstraint, Boolean, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
-from config.db import engine
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+import datetime
 
 Base = declarative_base()
 
+# Username в Telegram не зависит от регистра. В MySQL это даёт collation по умолчанию,
+# в sqlite нужен NOCASE, чтобы поиск по username работал одинаково
+Username = String(255).with_variant(String(255, collation='NOCASE'), 'sqlite')
+
 
 class User(Base):
     __tablename__ = 'users'
@@ -14,12 +18,17 @@ class User(Base):
     telegram_user_id = Column(String(255), nullable=False)
     chat_id = Column(String(255), nullable=False)
     is_manager = Column(Boolean, default=False)
-    username = Column(String(255), nullable=False)
-    score = Column(Integer, default=0)
+    username = Column(Username, nullable=False)
+    # Счёт хранится в user_scores. Прежние колонки score, added_since_reset и subtracted_since_reset
+    # остались в БД для отката, но приложением не читаются и не пишутся
 
     messages = relationship('Message', back_populates='user')
 
-    __table_args__ = (UniqueConstraint('telegram_user_id', 'chat_id', name='unique_user_chat'),)
+    __table_args__ = (
+        UniqueConstraint('telegram_user_id', 'chat_id', name='unique_user_chat'),
+        # Поиск пользователя чата по username
+        Index('ix_users_chat_username', 'chat_id', 'username'),
+    )
 
 
 class Chat(Base):
@@ -31,6 +40,23 @@ class Chat(Base):
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
     last_reset = Column(DateTime, nullable=True)
+    # Номер текущего сезона. Очистка счёта начинает новый сезон, не трогая строки пользователей
+    epoch = Column(Integer, nullable=False, default=1, server_default='1')
+
+
+class UserScore(Base):
+    __tablename__ = 'user_scores'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    epoch = Column(Integer, primary_key=True, autoincrement=False)
+    chat_id = Column(String(255), nullable=False)
+    score = Column(Integer, nullable=False, default=0, server_default='0')
+    # Сколько баллов добавили и отняли за сезон
+    added = Column(Integer, nullable=False, default=0, server_default='0')
+    subtracted = Column(Integer, nullable=False, default=0, server_default='0')
+
+    # Топ чата за сезон
+    __table_args__ = (Index('ix_user_scores_chat_epoch_score', 'chat_id', 'epoch', 'score'),)
 
 
 class Message(Base):
@@ -41,10 +67,17 @@ class Message(Base):
     points = Column(Integer, nullable=False)
     message = Column(Text, nullable=True)
     from_username = Column(String(255), nullable=False)
-    created_at = Column(DateTime, server_default=func.now())
+    # Сезон чата, в котором было начисление
+    epoch = Column(Integer, nullable=False, default=1, server_default='1')
+    # Время ставит приложение, как и last_reset: в sqlite CURRENT_TIMESTAMP в UTC, а не в локальном времени
+    created_at = Column(DateTime, server_default=func.now(), default=datetime.datetime.now)
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
     user = relationship('User', back_populates='messages')
 
+    # История фильтрует сообщения пользователя по сезону и сортирует их по дате
+    __table_args__ = (
+        Index('ix_messages_user_created', 'user_id', 'created_at'),
+        Index('ix_messages_user_epoch_created', 'user_id', 'epoch', 'created_at'),
+    )
 
-Base.metadata.create_all(engine)
@@ -1,10 +1,19 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from lib.helpers import env_variables
+import time
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from lib.classes.MetricsRegistry import metrics
+from lib.errors import log_error
+from lib.helpers import env_variables, is_async_runtime
 
-import pymysql
+# mysql или sqlite
+db_backend = env_variables.get('DB_BACKEND') or 'mysql'
 
-pymysql.install_as_MySQLdb()
+if db_backend == 'mysql':
+    import pymysql
+
+    pymysql.install_as_MySQLdb()
 
 username = env_variables.get('DB_USERNAME')
 password = env_variables.get('DB_PASSWORD')
@@ -12,17 +21,140 @@ host = env_variables.get('DB_HOST')
 port = env_variables.get('DB_PORT')
 db_name = env_variables.get('DB_NAME')
 
-DATABASE_URL = f"mysql+pymysql://{username}:"
-if password:
-    DATABASE_URL += password
-DATABASE_URL += f"@{host}"
-if port:
-    DATABASE_URL += f":{port}"
-DATABASE_URL += f"/{db_name}?charset=utf8mb4"
+# Файл базы для sqlite
+db_path = env_variables.get('DB_PATH') or 'botushka.db'
+
+# Настройки пула соединений
+pool_options = {
+    'pool_size': int(env_variables.get('DB_POOL_SIZE') or 10),
+    'max_overflow': int(env_variables.get('DB_MAX_OVERFLOW') or 10),
+    'pool_recycle': int(env_variables.get('DB_POOL_RECYCLE') or 3600),
+    'pool_timeout': float(env_variables.get('DB_POOL_TIMEOUT') or 30),
+    'pool_pre_ping': True,
+}
+
+# Ожидание соединения дольше этого (в секундах) пишется в лог
+pool_wait_warning = float(env_variables.get('DB_POOL_WAIT_WARNING') or 0.5)
+
+
+# Ожидание свободного соединения обычно нулевое, корзины мелкие
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class PoolCheckoutStats:
+    """
+    Сколько раз и как долго потоки ждали свободное соединение из пула:
+    распределение попадает в /metrics, долгие ожидания - в лог
+    """
+
+    def __init__(self):
+        self.wait = metrics.histogram('botushka_db_pool_wait_seconds',
+                                      "Ожидание свободного соединения из пула БД", (), POOL_WAIT_BUCKETS)
+
+    def observe(self, seconds):
+        self.wait.observe(seconds)
+        if seconds > pool_wait_warning:
+            log_error(f"db pool checkout waited {seconds:.3f}s")
+
+
+pool_checkout_stats = PoolCheckoutStats()
+
+
+class TimedPoolMixin:
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_checkout_stats.observe(time.perf_counter() - started)
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def build_database_url(is_async=False):
+    """
+    Строка подключения к выбранной в DB_BACKEND базе
+
+    :param is_async: Строка для асинхронного драйвера (aiomysql/aiosqlite)
+    :return:
+    """
+    if db_backend == 'sqlite':
+        return f"sqlite+{'aiosqlite' if is_async else 'pysqlite'}:///{db_path}"
+
+    url = f"mysql+{'aiomysql' if is_async else 'pymysql'}://{username}:"
+    if password:
+        url += password
+    url += f"@{host}"
+    if port:
+        url += f":{port}"
+    url += f"/{db_name}?charset=utf8mb4"
+    return url
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL позволяет читать во время записи, synchronous=NORMAL в WAL режиме безопасен
+    и не делает fsync на каждый коммит
+
+    :param dbapi_connection:
+    :param connection_record:
+    :return:
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute(f"PRAGMA busy_timeout={int(env_variables.get('DB_SQLITE_BUSY_TIMEOUT') or 5000)}")
+    cursor.execute(f"PRAGMA mmap_size={int(env_variables.get('DB_SQLITE_MMAP_SIZE') or 268435456)}")
+    # Отрицательное значение - размер кэша в килобайтах
+    cursor.execute(f"PRAGMA cache_size={int(env_variables.get('DB_SQLITE_CACHE_SIZE') or -65536)}")
+    cursor.close()
+
+
+DATABASE_URL = build_database_url()
+
+# Создаем соединение с базой данных
+engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, **pool_options)
+if db_backend == 'sqlite':
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+
+if is_async_runtime():
+    from greenlet import getcurrent
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    # Асинхронный движок. Синхронная сессия поверх него работает внутри greenlet_spawn,
+    # так что crud остаётся прежним, а запросы к БД не блокируют event loop
+    async_engine = create_async_engine(build_database_url(is_async=True), poolclass=TimedAsyncAdaptedQueuePool,
+                                       **pool_options)
+    if db_backend == 'sqlite':
+        event.listen(async_engine.sync_engine, 'connect', set_sqlite_pragmas)
+    Session = sessionmaker(bind=async_engine.sync_engine)
+    # Каждый обработчик выполняется в своём greenlet, и сессия у него своя
+    session = scoped_session(Session, scopefunc=getcurrent)
+else:
+    # Создаем сессию, у каждого потока (воркера диспетчера) она своя
+    Session = sessionmaker(bind=engine)
+    session = scoped_session(Session)
+
 
-# Создаем соединение с базой данных MySQL
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+@contextmanager
+def unit_of_work():
+    """
+    Одна единица работы (обработка апдейта, запись пачки): по завершении сессия закрывается
+    и соединение возвращается в пул, при ошибке незавершённая транзакция откатывается
 
-# Создаем сессию
-Session = sessionmaker(bind=engine)
-session = Session()
\ No newline at end of file
+    :return:
+    """
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.remove()
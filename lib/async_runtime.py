@@ -0,0 +1,128 @@
+import asyncio
+import weakref
+from sqlalchemy.util import greenlet_spawn
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import CallbackQuery
+from app.handlers import commands, register_handlers, allowed_updates
+from config.db import unit_of_work
+from lib.classes.AsyncBotBridge import AsyncBotBridge
+from lib.classes.UserRegistrationWriter import registration_writer
+from lib.classes.OutboundScheduler import outbound_scheduler
+from lib.errors import log_error
+from lib.metrics import start_metrics_server
+from lib.cache import invalidation_bus
+
+# Блокировки по чатам, чтобы апдейты одного чата обрабатывались по порядку.
+# Неиспользуемые блокировки удаляются сами
+chat_locks = weakref.WeakValueDictionary()
+
+
+def get_chat_lock(update):
+    """
+    Блокировка чата, к которому относится сообщение или нажатие кнопки
+
+    :param update: Message или CallbackQuery
+    :return:
+    """
+    if isinstance(update, CallbackQuery):
+        chat_id = update.message.chat.id if update.message else update.from_user.id
+    else:
+        chat_id = update.chat.id
+
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        chat_locks[chat_id] = lock
+    return lock
+
+
+def run_handler(handler, update, bot):
+    """
+    Выполняет синхронный обработчик внутри greenlet и закрывает его сессию
+
+    :param handler:
+    :param update:
+    :param bot: AsyncBotBridge
+    :return:
+    """
+    try:
+        with unit_of_work():
+            handler(update, bot)
+    except Exception as e:
+        log_error(f"{handler.__name__} {str(e)}")
+
+
+def make_async_handler(handler, bot):
+    """
+    Оборачивает синхронный обработчик в корутину для AsyncTeleBot
+
+    :param handler:
+    :param bot: AsyncBotBridge
+    :return:
+    """
+    async def async_handler(update):
+        async with get_chat_lock(update):
+            await greenlet_spawn(run_handler, handler, update, bot)
+
+    async_handler.__name__ = handler.__name__
+    return async_handler
+
+
+async def flush_registrations():
+    """
+    Периодическая запись буфера регистраций внутри event loop
+
+    :return:
+    """
+    registration_writer.running = True
+    while True:
+        await asyncio.sleep(registration_writer.flush_interval)
+        try:
+            await greenlet_spawn(run_flush)
+        except Exception as e:
+            # Одна неудачная запись не должна останавливать регистрацию до перезапуска
+            log_error(f"registration flush {str(e)}")
+
+
+def run_flush():
+    with unit_of_work():
+        registration_writer.flush()
+
+
+async def main(token):
+    async_bot = AsyncTeleBot(token)
+    bridge = AsyncBotBridge(async_bot)
+
+    await async_bot.set_my_commands(commands)
+    register_handlers(async_bot, lambda handler: make_async_handler(handler, bridge))
+    # Исходящие сообщения идут через ту же очередь с лимитами, что и в синхронном режиме
+    outbound_scheduler.start_async()
+    start_metrics_server()
+    invalidation_bus.start()
+
+    flush_task = asyncio.create_task(flush_registrations())
+    try:
+        await async_bot.delete_webhook()
+        await async_bot.infinity_polling(allowed_updates=allowed_updates)
+    finally:
+        flush_task.cancel()
+        try:
+            await flush_task
+        except asyncio.CancelledError:
+            pass
+        # Пользователи, которые ещё ждут в буфере, записываются до выхода
+        try:
+            await greenlet_spawn(run_flush)
+        except Exception as e:
+            log_error(f"registration flush {str(e)}")
+
+
+def run_async_bot(token):
+    """
+    Запуск бота на AsyncTeleBot: обработчики те же, что и в синхронном режиме,
+    но запросы к Telegram и БД из разных чатов выполняются одновременно в одном потоке
+
+    :param token:
+    :return:
+    """
+    asyncio.run(main(token))
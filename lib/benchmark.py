@@ -0,0 +1,299 @@
+import random
+import time
+from collections import Counter
+import telebot
+from telebot import apihelper
+from telebot.types import Update
+from sqlalchemy import event
+from config.db import engine, unit_of_work
+from app.handlers import register_handlers
+
+# id бота в синтетическом мире
+BOT_ID = 1
+BOT_USERNAME = 'bench_bot'
+
+# Команды, которые попадают в поток апдейтов
+BENCH_COMMANDS = ('/top', '/get_user_score', '/help')
+
+# Кнопки меню настроек, которые нажимают администраторы в личке
+BENCH_CALLBACKS = ('chats', 'aodd', 'smch')
+
+# Права администратора в ответе getChatAdministrators
+ADMIN_RIGHTS = ('can_be_edited', 'can_manage_chat', 'can_delete_messages', 'can_manage_video_chats',
+                'can_restrict_members', 'can_promote_members', 'can_change_info', 'can_invite_users',
+                'can_post_stories', 'can_edit_stories', 'can_delete_stories')
+
+CHATTER_WORDS = ('привет', 'спасибо', 'завтра', 'релиз', 'в', '10', 'созвон', 'ок', 'посмотри', 'PR', 'C++', 'e-mail')
+
+
+class FakeResponse:
+    """
+    Ответ Bot API в том виде, в каком его разбирает telebot.apihelper
+    """
+
+    def __init__(self, result):
+        self.status_code = 200
+        self.result = result
+        self.text = ''
+
+    def json(self):
+        return {'ok': True, 'result': self.result}
+
+
+class RecordingBot(telebot.TeleBot):
+    """
+    TeleBot, который не ходит в сеть: запросы к Bot API перехватываются на уровне apihelper,
+    считаются по методам и получают правдоподобные ответы. Обработчики работают с ним как с настоящим ботом
+    """
+
+    def __init__(self, world):
+        super().__init__('1:bench', threaded=False)
+        self.world = world
+        self.calls = Counter()
+        self.message_id = 0
+
+    def install(self):
+        apihelper.CUSTOM_REQUEST_SENDER = self.send_request
+
+    @staticmethod
+    def uninstall():
+        apihelper.CUSTOM_REQUEST_SENDER = None
+
+    def send_request(self, method, url, params=None, files=None, **kwargs):
+        method_name = url.rsplit('/', 1)[-1]
+        self.calls[method_name] += 1
+        params = params or {}
+
+        if method_name == 'getMe':
+            return FakeResponse({'id': BOT_ID, 'is_bot': True, 'first_name': 'bench', 'username': BOT_USERNAME})
+        if method_name == 'getChatAdministrators':
+            admins = self.world.get_admins(int(params['chat_id']))
+            return FakeResponse([{'status': 'creator', 'user': admins[0], 'is_anonymous': False}] +
+                                [{'status': 'administrator', 'user': user, 'is_anonymous': False,
+                                  **dict.fromkeys(ADMIN_RIGHTS, True)} for user in admins[1:]])
+        if method_name in ('sendMessage', 'editMessageText', 'sendDocument'):
+            self.message_id += 1
+            chat_id = int(params['chat_id'])
+            return FakeResponse({'message_id': self.message_id, 'date': int(time.time()),
+                                 'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+                                 'from': self.world.get_bot_user(), 'text': params.get('text', '')})
+        return FakeResponse(True)
+
+
+class SqlCounter:
+    """
+    Считает SQL запросы, выполненные через engine
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def install(self):
+        event.listen(engine, 'before_cursor_execute', self.observe)
+
+    def uninstall(self):
+        event.remove(engine, 'before_cursor_execute', self.observe)
+
+    def observe(self, *args):
+        self.count += 1
+
+
+class SyntheticWorld:
+    """
+    Синтетические чаты и их участники и поток апдейтов по ним.
+    Доли задаются от всех апдейтов, кроме multi_mention_ratio - это доля голосов с несколькими упоминаниями
+    """
+
+    def __init__(self, chats, members, vote_ratio, multi_mention_ratio, reply_ratio, command_ratio,
+                 callback_ratio, seed):
+        self.chats = chats
+        self.members = members
+        self.vote_ratio = vote_ratio
+        self.multi_mention_ratio = multi_mention_ratio
+        self.reply_ratio = reply_ratio
+        self.command_ratio = command_ratio
+        self.callback_ratio = callback_ratio
+        self.random = random.Random(seed)
+        self.update_id = 0
+        self.message_id = 0
+
+    @staticmethod
+    def get_chat_id(chat_index):
+        return -1000000000000 - chat_index
+
+    def get_user(self, chat_index, member_index):
+        telegram_user_id = 1000 + chat_index * self.members + member_index
+        return {'id': telegram_user_id, 'is_bot': False, 'first_name': f"User {telegram_user_id}",
+                'username': f"user{telegram_user_id}"}
+
+    @staticmethod
+    def get_bot_user():
+        return {'id': BOT_ID, 'is_bot': True, 'first_name': 'bench', 'username': BOT_USERNAME}
+
+    def get_admins(self, chat_id):
+        # Первые два участника каждого чата - его администраторы
+        chat_index = -1000000000000 - chat_id
+        return [self.get_user(chat_index, member_index) for member_index in range(min(2, self.members))]
+
+    def build_message(self, chat_index, user, text, **fields):
+        self.message_id += 1
+        message = {'message_id': self.message_id, 'date': int(time.time()), 'from': user, 'text': text,
+                   'chat': {'id': self.get_chat_id(chat_index), 'type': 'supergroup', 'title': f"Chat {chat_index}"}}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        message.update(fields)
+        return message
+
+    def build_update(self, **fields):
+        self.update_id += 1
+        return Update.de_json({'update_id': self.update_id, **fields})
+
+    def iter_setup_updates(self):
+        """
+        Бота добавляют в каждый чат, затем каждый участник пишет по сообщению и регистрируется
+
+        :return: Генератор Update
+        """
+        for chat_index in range(self.chats):
+            yield self.build_update(message=self.build_message(
+                chat_index, self.get_user(chat_index, 0), '', new_chat_members=[self.get_bot_user()]))
+            for member_index in range(self.members):
+                yield self.build_update(message=self.build_message(
+                    chat_index, self.get_user(chat_index, member_index), self.get_chatter()))
+
+    def iter_updates(self, count):
+        """
+        Поток апдейтов заданного состава
+
+        :param count:
+        :return: Генератор кортежей (вид апдейта, Update)
+        """
+        for _ in range(count):
+            chat_index = self.random.randrange(self.chats)
+            user = self.get_user(chat_index, self.random.randrange(self.members))
+            kind = self.random.random()
+            if kind < self.vote_ratio:
+                yield 'vote', self.build_update(message=self.build_vote(chat_index, user))
+            elif kind < self.vote_ratio + self.reply_ratio:
+                target = self.get_user(chat_index, self.random.randrange(self.members))
+                reply_to_message = self.build_message(chat_index, target, self.get_chatter())
+                yield 'reply', self.build_update(message=self.build_message(
+                    chat_index, user, f"{self.random.choice(('++', '--', '+1'))} {self.get_chatter()}",
+                    reply_to_message=reply_to_message))
+            elif kind < self.vote_ratio + self.reply_ratio + self.command_ratio:
+                command = self.random.choice(BENCH_COMMANDS)
+                if command == '/get_user_score':
+                    member = self.get_user(chat_index, self.random.randrange(self.members))
+                    command = f"{command} @{member['username']}"
+                yield 'command', self.build_update(message=self.build_message(chat_index, user, command))
+            elif kind < self.vote_ratio + self.reply_ratio + self.command_ratio + self.callback_ratio:
+                yield 'callback', self.build_update(callback_query=self.build_callback(chat_index))
+            else:
+                yield 'chatter', self.build_update(message=self.build_message(chat_index, user, self.get_chatter()))
+
+    def build_vote(self, chat_index, user):
+        mentions_count = self.random.randint(2, 4) if self.random.random() < self.multi_mention_ratio else 1
+        targets = [self.get_user(chat_index, self.random.randrange(self.members)) for _ in range(mentions_count)]
+        mentions = ' '.join(f"@{target['username']}" for target in targets)
+        text = f"{mentions} {self.random.choice(('++', '--', '+1', '-1', '—'))} {self.get_chatter()}"
+        entities = []
+        offset = 0
+        for target in targets:
+            # Telegram присылает упоминания разметкой, как и в настоящем чате
+            entities.append({'type': 'mention', 'offset': offset, 'length': len(target['username']) + 1})
+            offset += len(target['username']) + 2
+        return self.build_message(chat_index, user, text, entities=entities)
+
+    def build_callback(self, chat_index):
+        # Меню настроек открывают в личке администраторы
+        admin = self.get_user(chat_index, 0)
+        self.message_id += 1
+        return {'id': str(self.message_id), 'from': admin, 'chat_instance': str(admin['id']),
+                'data': self.random.choice(BENCH_CALLBACKS),
+                'message': {'message_id': self.message_id, 'date': int(time.time()), 'from': self.get_bot_user(),
+                            'chat': {'id': admin['id'], 'type': 'private'}, 'text': "Выберите кнопку:"}}
+
+    def get_chatter(self):
+        return ' '.join(self.random.choice(CHATTER_WORDS) for _ in range(self.random.randint(1, 10)))
+
+
+class KindStats:
+    __slots__ = ('latencies', 'statements', 'api_calls')
+
+    def __init__(self):
+        self.latencies = []
+        self.statements = 0
+        self.api_calls = 0
+
+    def add(self, latency, statements, api_calls):
+        self.latencies.append(latency)
+        self.statements += statements
+        self.api_calls += api_calls
+
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+
+def run_benchmark(world, updates_count):
+    """
+    Прогоняет синтетические апдейты через настоящие обработчики так же, как воркер диспетчера:
+    по одному, каждый в своей единице работы
+
+    :param world: SyntheticWorld
+    :param updates_count: Кол-во апдейтов после подготовки чатов
+    :return: Кортеж (словарь вид апдейта -> KindStats, общее время в секундах, счётчик вызовов Bot API)
+    """
+    bot = RecordingBot(world)
+    register_handlers(bot)
+    sql_counter = SqlCounter()
+    bot.install()
+    sql_counter.install()
+    try:
+        for update in world.iter_setup_updates():
+            with unit_of_work():
+                bot.process_new_updates([update])
+        bot.calls.clear()
+
+        stats = {}
+        started = time.perf_counter()
+        for kind, update in world.iter_updates(updates_count):
+            statements = sql_counter.count
+            api_calls = sum(bot.calls.values())
+            update_started = time.perf_counter()
+            with unit_of_work():
+                bot.process_new_updates([update])
+            latency = time.perf_counter() - update_started
+            stats.setdefault(kind, KindStats()).add(latency, sql_counter.count - statements,
+                                                    sum(bot.calls.values()) - api_calls)
+        elapsed = time.perf_counter() - started
+    finally:
+        sql_counter.uninstall()
+        bot.uninstall()
+    return stats, elapsed, bot.calls
+
+
+def format_report(stats, elapsed, calls):
+    """
+    Таблица результатов: скорость, задержки обработчиков, запросы к БД и вызовы Bot API на апдейт
+
+    :return: Строка отчёта
+    """
+    total = KindStats()
+    for kind_stats in stats.values():
+        total.latencies += kind_stats.latencies
+        total.statements += kind_stats.statements
+        total.api_calls += kind_stats.api_calls
+
+    lines = [f"Апдейтов: {len(total.latencies)} за {elapsed:.2f} с, {len(total.latencies) / elapsed:.0f} апдейтов/с",
+             f"{'вид':<10}{'кол-во':>8}{'p50, мс':>10}{'p99, мс':>10}{'SQL/апд':>10}{'API/апд':>10}"]
+    for kind, kind_stats in sorted(stats.items()) + [('всего', total)]:
+        latencies = sorted(kind_stats.latencies)
+        count = len(latencies)
+        lines.append(f"{kind:<10}{count:>8}{get_percentile(latencies, 50) * 1000:>10.2f}"
+                     f"{get_percentile(latencies, 99) * 1000:>10.2f}{kind_stats.statements / count:>10.2f}"
+                     f"{kind_stats.api_calls / count:>10.2f}")
+    lines.append("Вызовы Bot API: " + ', '.join(f"{method} {count}" for method, count in calls.most_common()))
+    return '\n'.join(lines)
@@ -0,0 +1,62 @@
+from datetime import timedelta
+from lib.classes.AutoRefreshTTLCache import AutoRefreshTTLCache
+from lib.classes.SharedCache import SharedCacheClient, SharedCacheBackend, InvalidationBus
+from lib.helpers import env_variables
+
+# local - кэш в памяти процесса, shared - общий для процессов бота через manage.py cache_server
+cache_backend = env_variables.get('CACHE_BACKEND') or 'local'
+cache_socket = env_variables.get('CACHE_SOCKET') or '/tmp/botushka-cache.sock'
+# Дольше ждать сервер кэша нет смысла, проще сходить в БД
+cache_socket_timeout = float(env_variables.get('CACHE_SOCKET_TIMEOUT') or 0.1)
+
+# Вид данных -> (maxsize, ttl, negative_ttl) по умолчанию
+CACHE_NAMESPACES = {
+    # Есть ли чат в БД, ключ - str(chat_id)
+    'chat_exist': (10000, timedelta(days=1).total_seconds(), timedelta(minutes=1).total_seconds()),
+    # telegram_user_id по id пользователя в БД
+    'user_id': (10000, timedelta(days=1).total_seconds(), timedelta(minutes=1).total_seconds()),
+    # Настройка send_few_carma чата, ключ - str(chat_id)
+    'chat_setting': (10000, timedelta(days=1).total_seconds(), timedelta(minutes=1).total_seconds()),
+    # Может ли пользователь управлять чатом, ключ - (str(chat_id), str(telegram_user_id))
+    'can_manage': (50000, timedelta(days=1).total_seconds(), timedelta(minutes=1).total_seconds()),
+}
+
+shared_cache_client = SharedCacheClient(cache_socket, cache_socket_timeout) if cache_backend == 'shared' else None
+
+
+def get_namespace_settings(namespace):
+    """
+    Размер и TTL вида данных, их можно переопределить в .env:
+    CACHE_<NAMESPACE>_MAXSIZE, CACHE_<NAMESPACE>_TTL, CACHE_<NAMESPACE>_NEGATIVE_TTL
+
+    :param namespace: Вид данных, например can_manage
+    :return: Кортеж (maxsize, ttl, negative_ttl), negative_ttl None - промахи не кэшируются
+    """
+    maxsize, ttl, negative_ttl = CACHE_NAMESPACES[namespace]
+    prefix = f"CACHE_{namespace.upper()}_"
+    negative_ttl = env_variables.get(prefix + 'NEGATIVE_TTL') or negative_ttl
+    return (int(env_variables.get(prefix + 'MAXSIZE') or maxsize), float(env_variables.get(prefix + 'TTL') or ttl),
+            float(negative_ttl) if negative_ttl else None)
+
+
+def build_cache(namespace):
+    """
+    Кэш одного вида данных: в памяти процесса или на сервере кэша, смотря по CACHE_BACKEND
+
+    :param namespace: Вид данных из CACHE_NAMESPACES
+    :return: CacheBackend
+    """
+    if shared_cache_client is not None:
+        return SharedCacheBackend(shared_cache_client, namespace)
+    maxsize, ttl, negative_ttl = get_namespace_settings(namespace)
+    return AutoRefreshTTLCache(maxsize=maxsize, ttl=ttl, negative_ttl=negative_ttl)
+
+
+chat_exist_cache = build_cache('chat_exist')
+user_id_cache = build_cache('user_id')
+chat_setting_cache = build_cache('chat_setting')
+can_manage_cache = build_cache('can_manage')
+
+# Справочники участников, рейтинги и администраторы чатов остаются в памяти каждого процесса,
+# об их изменениях процессы сообщают друг другу через шину
+invalidation_bus = InvalidationBus(shared_cache_client)
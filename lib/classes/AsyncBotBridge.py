@@ -0,0 +1,58 @@
+import asyncio
+import time
+from inspect import iscoroutinefunction
+from sqlalchemy.util import await_only
+from telebot.asyncio_helper import ApiTelegramException
+from lib.metrics import get_api_method_name, observe_api_call
+
+
+class AsyncBotBridge:
+    """
+    Синхронный фасад над AsyncTeleBot для обработчиков, запущенных через greenlet_spawn.
+    Вызов метода бота переключает greenlet обратно в event loop до получения ответа,
+    поэтому пока один обработчик ждёт Telegram, остальные продолжают работать.
+    """
+
+    def __init__(self, async_bot):
+        self.async_bot = async_bot
+
+    def __getattr__(self, name):
+        attr = getattr(self.async_bot, name)
+        if not iscoroutinefunction(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await_only(attr(*args, **kwargs))
+            except Exception as e:
+                observe_api_call(get_api_method_name(name), started, self.get_status(e))
+                raise
+            observe_api_call(get_api_method_name(name), started, '200')
+            return result
+
+        return call
+
+    @staticmethod
+    def get_status(result):
+        # Статус для метрик: код ошибки Telegram или 200, как у HTTP ответа в синхронном режиме
+        if isinstance(result, ApiTelegramException):
+            return str(result.error_code)
+        if isinstance(result, Exception):
+            return 'error'
+        return '200'
+
+    def gather(self, name, args_list):
+        """
+        Вызывает метод бота для нескольких наборов аргументов одновременно
+
+        :param name: Имя метода, например get_chat_administrators
+        :param args_list: Список кортежей аргументов
+        :return: Список ответов или исключений в том же порядке
+        """
+        method = getattr(self.async_bot, name)
+        started = time.perf_counter()
+        results = await_only(asyncio.gather(*(method(*args) for args in args_list), return_exceptions=True))
+        for result in results:
+            observe_api_call(get_api_method_name(name), started, self.get_status(result))
+        return results
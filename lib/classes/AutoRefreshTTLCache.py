@@ -1,22 +1,171 @@
-from cachetools import TTLCache
-from datetime import timedelta
+import threading
+import time
+from collections import OrderedDict
+from lib.classes.CacheBackend import CacheBackend, Flight, MISSING
 
+# Кол-во независимых частей кэша со своими блокировками
+DEFAULT_STRIPES = 16
 
-class AutoRefreshTTLCache:
-    def __init__(self, maxsize, ttl):
-        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+class CacheStripe:
+    """
+    Часть кэша под своей блокировкой. Записи лежат в порядке истечения TTL:
+    чтение продлевает запись на месте и переносит её в конец, без повторной вставки
+    """
+
+    def __init__(self, maxsize, negative_maxsize):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.negative_maxsize = negative_maxsize
+        self.entries = OrderedDict()  # ключ -> [значение, время истечения]
+        self.negative = OrderedDict()
+        self.flights = {}
+
+    def get(self, key, ttl, now):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                entry[1] = now + ttl
+                self.entries.move_to_end(key)
+                return entry[0]
+            del self.entries[key]
+
+        entry = self.negative.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                return entry[0]
+            del self.negative[key]
+        return MISSING
+
+    @staticmethod
+    def put(entries, maxsize, key, value, expires_at, now):
+        entries[key] = [value, expires_at]
+        entries.move_to_end(key)
+        # Первыми истекают записи в начале, их и вытесняем
+        while entries and (len(entries) > maxsize or next(iter(entries.values()))[1] <= now):
+            entries.popitem(last=False)
+
+    def set(self, key, value, ttl, now):
+        self.negative.pop(key, None)
+        self.put(self.entries, self.maxsize, key, value, now + ttl, now)
+        self.mark_stale(key)
+
+    def set_negative(self, key, value, negative_ttl, now):
+        self.entries.pop(key, None)
+        self.put(self.negative, self.negative_maxsize, key, value, now + negative_ttl, now)
+        self.mark_stale(key)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+        self.negative.pop(key, None)
+        self.mark_stale(key)
+
+    def mark_stale(self, key):
+        flight = self.flights.pop(key, None)
+        if flight is not None:
+            flight.stale = True
+
+
+class AutoRefreshTTLCache(CacheBackend):
+    """
+    TTL кэш, в котором чтение продлевает жизнь записи. Разбит на части со своими блокировками,
+    так что потоки обработчиков не мешают друг другу.
+    Отрицательные записи ("такого нет") хранятся отдельно с коротким TTL и чтением не продлеваются:
+    повторные запросы несуществующего не идут в БД, но и устаревший ответ живёт недолго.
+    get_or_load загружает промах один раз, сколько бы читателей ни пришло за ним одновременно
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl=None, negative_maxsize=None, stripes=DEFAULT_STRIPES):
         self.ttl = ttl
+        # Без negative_ttl промахи не кэшируются
+        self.negative_ttl = negative_ttl
+        stripes = max(1, min(stripes, maxsize))
+        negative_maxsize = negative_maxsize or maxsize
+        self.stripes = [CacheStripe(max(1, maxsize // stripes), max(1, negative_maxsize // stripes))
+                        for _ in range(stripes)]
 
-    def get(self, key):
-        # Получаем значение и обновляем TTL
-        value = self.cache.get(key)
-        if value:
-            # Перезаписываем с новым временем
-            self.cache[key] = value
-        return value
+    def get_stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def get(self, key, default=None):
+        stripe = self.get_stripe(key)
+        with stripe.lock:
+            value = stripe.get(key, self.ttl, time.monotonic())
+        return default if value is MISSING else value
 
     def set(self, key, value):
-        self.cache[key] = value
+        stripe = self.get_stripe(key)
+        with stripe.lock:
+            stripe.set(key, value, self.ttl, time.monotonic())
+
+    def set_negative(self, key, value=None):
+        """
+        Запоминает, что значения нет, на negative_ttl
+
+        :param key:
+        :param value: Что вернёт get, пока запись жива
+        :return:
+        """
+        stripe = self.get_stripe(key)
+        with stripe.lock:
+            if self.negative_ttl:
+                stripe.set_negative(key, value, self.negative_ttl, time.monotonic())
+            else:
+                stripe.delete(key)
+
+    def delete(self, key):
+        stripe = self.get_stripe(key)
+        with stripe.lock:
+            stripe.delete(key)
 
+    def clear(self):
+        for stripe in self.stripes:
+            with stripe.lock:
+                for key in list(stripe.entries) + list(stripe.negative):
+                    stripe.delete(key)
 
-user_cache = AutoRefreshTTLCache(maxsize=1000, ttl=timedelta(days=1).total_seconds())
+    def get_or_load(self, key, loader):
+        """
+        Значение из кэша, а при промахе - из loader. Одновременные промахи по одному ключу
+        ждут одну загрузку. Блокировка на время loader не держится: в асинхронном режиме
+        он переключается в event loop, и другие greenlet'ы того же потока продолжают работать
+
+        :param key:
+        :param loader: Функция без аргументов, None в ответе кэшируется как отрицательная запись
+        :return:
+        """
+        stripe = self.get_stripe(key)
+        with stripe.lock:
+            value = stripe.get(key, self.ttl, time.monotonic())
+            if value is not MISSING:
+                return value
+            flight = stripe.flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = stripe.flights[key] = Flight()
+
+        if not is_leader:
+            value = flight.wait()
+            if value is not MISSING:
+                return value
+            # Загрузку ведёт поток, которого greenlet ждать не может, загружаем сами
+            return loader()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with stripe.lock:
+                if stripe.flights.get(key) is flight:
+                    del stripe.flights[key]
+            flight.finish(error=e)
+            raise
+
+        with stripe.lock:
+            if not flight.stale:
+                del stripe.flights[key]
+                if value is not None:
+                    stripe.set(key, value, self.ttl, time.monotonic())
+                elif self.negative_ttl:
+                    stripe.set_negative(key, value, self.negative_ttl, time.monotonic())
+        flight.finish(value)
+        return value
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+from sqlalchemy.util import await_only
+from sqlalchemy.util.concurrency import in_greenlet
+
+# Значение get по умолчанию, чтобы отличить промах от закэшированных False, None и 0
+MISSING = object()
+
+
+class Flight:
+    """
+    Загрузка значения, которую ждут остальные читатели того же ключа.
+    Потоки ждут threading.Event, greenlet'ы асинхронного режима - future в event loop,
+    чтобы не блокировать поток, в котором выполняется и сама загрузка
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.future = asyncio.get_running_loop().create_future() if in_greenlet() else None
+        self.value = None
+        self.error = None
+        # Ключ изменили или удалили во время загрузки: результат отдаём ждущим, но не кэшируем
+        self.stale = False
+
+    def finish(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+        if self.future is not None and not self.future.done():
+            self.future.set_result(None)
+
+    def wait(self):
+        """
+        :return: Загруженное значение или MISSING, если подождать из этого контекста нельзя
+        """
+        if in_greenlet():
+            if self.future is None:
+                return MISSING
+            await_only(asyncio.shield(self.future))
+        else:
+            self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class CacheBackend:
+    """
+    Интерфейс кэша одного вида данных. Реализации: AutoRefreshTTLCache в памяти процесса
+    и SharedCacheBackend, общий для процессов бота на одном сервере
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def set_negative(self, key, value=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def get_or_load(self, key, loader):
+        raise NotImplementedError
@@ -0,0 +1,134 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from cachetools import TTLCache
+from lib.classes.AsyncBotBridge import AsyncBotBridge
+from lib.cache import invalidation_bus
+from lib.errors import log_error
+from lib.helpers import env_variables
+
+# Статусы участника, которые дают права администратора
+ADMIN_STATUSES = ('creator', 'administrator')
+
+
+class ChatAdmin:
+    __slots__ = ('telegram_user_id', 'username')
+
+    def __init__(self, telegram_user_id, username):
+        self.telegram_user_id = telegram_user_id
+        self.username = username
+
+
+class ChatAdminCache:
+    """
+    Списки администраторов чатов с TTL. Промахи по нескольким чатам запрашиваются у Telegram
+    одновременно, изменения прав из апдейтов chat_member применяются к кэшу сразу.
+    В отличие от AutoRefreshTTLCache, чтение не продлевает TTL: список должен периодически обновляться
+    """
+
+    def __init__(self, maxsize, ttl, workers):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        # Потоки пула создаются только при первом параллельном запросе
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-admins')
+        invalidation_bus.subscribe('chat_admins', self.drop)
+
+    def get(self, bot, chat_id):
+        """
+        Администраторы чата
+
+        :param bot:
+        :param chat_id:
+        :return: Список ChatAdmin, пустой если Telegram не ответил
+        """
+        return self.get_many(bot, [chat_id])[str(chat_id)]
+
+    def get_many(self, bot, chat_ids):
+        """
+        Администраторы нескольких чатов, промахи запрашиваются параллельно
+
+        :param bot: TeleBot или AsyncBotBridge
+        :param chat_ids:
+        :return: Словарь str(chat_id) -> список ChatAdmin
+        """
+        result = {}
+        missing = []
+        with self.lock:
+            for chat_id in chat_ids:
+                admins = self.cache.get(str(chat_id))
+                if admins is None:
+                    missing.append(chat_id)
+                else:
+                    result[str(chat_id)] = admins
+
+        for chat_id, members in zip(missing, self.fetch(bot, missing)):
+            if isinstance(members, Exception):
+                # Бота могли удалить из чата, в кэш такой ответ не кладём
+                log_error(f"get_chat_administrators {chat_id} {str(members)}")
+                result[str(chat_id)] = []
+                continue
+            admins = [ChatAdmin(member.user.id, member.user.username) for member in members]
+            with self.lock:
+                self.cache[str(chat_id)] = admins
+            result[str(chat_id)] = admins
+
+        return result
+
+    def fetch(self, bot, chat_ids):
+        """
+        Запрашивает администраторов чатов одновременно
+
+        :param bot:
+        :param chat_ids:
+        :return: Список ответов Telegram или исключений в порядке chat_ids
+        """
+        if not chat_ids:
+            return []
+        if isinstance(bot, AsyncBotBridge):
+            # В асинхронном режиме запросы идут в event loop через asyncio.gather
+            return bot.gather('get_chat_administrators', [(chat_id,) for chat_id in chat_ids])
+        if len(chat_ids) == 1:
+            return [self.call(bot, chat_ids[0])]
+        return list(self.executor.map(lambda chat_id: self.call(bot, chat_id), chat_ids))
+
+    @staticmethod
+    def call(bot, chat_id):
+        try:
+            return bot.get_chat_administrators(chat_id)
+        except Exception as e:
+            return e
+
+    def is_admin(self, bot, chat_id, telegram_user_id):
+        return any(admin.telegram_user_id == int(telegram_user_id) for admin in self.get(bot, chat_id))
+
+    def apply_member_update(self, chat_member_updated):
+        """
+        Применяет изменение прав участника из апдейта chat_member к закэшированному списку
+
+        :param chat_member_updated: ChatMemberUpdated
+        :return:
+        """
+        key = str(chat_member_updated.chat.id)
+        user = chat_member_updated.new_chat_member.user
+        # Апдейт приходит одному процессу бота, остальные запросят список заново
+        invalidation_bus.publish('chat_admins', key)
+        with self.lock:
+            admins = self.cache.get(key)
+            if admins is None:
+                return
+            admins = [admin for admin in admins if admin.telegram_user_id != user.id]
+            if chat_member_updated.new_chat_member.status in ADMIN_STATUSES:
+                admins.append(ChatAdmin(user.id, user.username))
+            self.cache[key] = admins
+
+    def drop(self, chat_id):
+        with self.lock:
+            if chat_id is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(chat_id, None)
+
+
+chat_admins = ChatAdminCache(maxsize=int(env_variables.get('CHAT_ADMINS_MAX_CHATS') or 10000),
+                             ttl=float(env_variables.get('CHAT_ADMINS_TTL') or timedelta(minutes=10).total_seconds()),
+                             workers=int(env_variables.get('CHAT_ADMINS_FETCH_WORKERS') or 8))
@@ -0,0 +1,77 @@
+import queue
+import threading
+from config.db import unit_of_work
+from lib.errors import log_error
+
+
+class ChatDispatcher:
+    """
+    Распределяет апдейты по очередям воркеров по chat.id.
+    Апдейты одного чата всегда попадают в одну очередь и обрабатываются строго по порядку,
+    разные чаты обрабатываются параллельно. У каждого воркера своя сессия БД на время апдейта.
+    """
+
+    def __init__(self, bot, shards, queue_size):
+        self.bot = bot
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.threads = []
+
+    def start(self):
+        for index, shard_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self.worker, args=(shard_queue,), name=f"chat-shard-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def dispatch(self, update, block=True):
+        """
+        Кладёт апдейт в очередь его чата
+
+        :param update:
+        :param block: Ждать ли места в очереди, если она заполнена
+        :return: False, если очередь заполнена и block=False
+        """
+        shard_queue = self.queues[self.get_shard_key(update) % len(self.queues)]
+        try:
+            shard_queue.put(update, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def worker(self, shard_queue):
+        while True:
+            update = shard_queue.get()
+            try:
+                # Каждый апдейт - отдельная единица работы со своей сессией
+                with unit_of_work():
+                    self.bot.process_new_updates([update])
+            except Exception as e:
+                log_error(f"chat dispatcher {str(e)}")
+            finally:
+                shard_queue.task_done()
+
+    @staticmethod
+    def get_shard_key(update):
+        """
+        Ключ шардирования апдейта: id чата, а если чата нет - id пользователя
+
+        :param update:
+        :return:
+        """
+        for item in (update.message, update.edited_message, update.channel_post, update.edited_channel_post,
+                     update.my_chat_member, update.chat_member, update.chat_join_request):
+            if item is not None:
+                return item.chat.id
+
+        if update.callback_query is not None:
+            if update.callback_query.message is not None:
+                return update.callback_query.message.chat.id
+            return update.callback_query.from_user.id
+
+        for item in (update.inline_query, update.chosen_inline_result, update.shipping_query,
+                     update.pre_checkout_query, update.poll_answer):
+            if item is not None:
+                user = getattr(item, 'from_user', None) or getattr(item, 'user', None)
+                if user is not None:
+                    return user.id
+
+        return update.update_id
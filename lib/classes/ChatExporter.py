@@ -0,0 +1,152 @@
+import asyncio
+import csv
+import io
+import json
+import queue
+import threading
+from tempfile import SpooledTemporaryFile
+from sqlalchemy.util import greenlet_spawn
+from telebot.apihelper import ApiTelegramException
+from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException
+from telebot.types import InputFile
+from app.bot_phrases import get_export_empty_message
+from config.db import unit_of_work
+from lib.classes.AsyncBotBridge import AsyncBotBridge
+from lib.classes.OutboundScheduler import outbound_scheduler, PRIORITY_INTERACTIVE
+from lib.crud import iter_chat_history
+from lib.errors import log_error
+from lib.helpers import env_variables
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+EXPORT_COLUMNS = ('id', 'created_at', 'season', 'username', 'telegram_user_id', 'points', 'from_username', 'message')
+
+
+class ExportJob:
+    __slots__ = ('bot', 'chat_id', 'reply_to_message_id', 'export_format')
+
+    def __init__(self, bot, chat_id, reply_to_message_id, export_format):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.export_format = export_format
+
+
+class ChatExporter:
+    """
+    Выгрузка истории начислений чата в CSV или JSONL в фоне.
+    Строки читаются из БД пачками и сразу пишутся во временный файл, который до spool_size байт
+    живёт в памяти, а дальше на диске. Обработка апдейтов чата выгрузку не ждёт
+    """
+
+    def __init__(self, workers, spool_size, batch_size):
+        self.workers = workers
+        self.spool_size = spool_size
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        # Ссылки на задачи асинхронного режима, иначе их может собрать сборщик мусора
+        self.tasks = set()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for index in range(self.workers):
+            threading.Thread(target=self.worker, name=f"chat-exporter-{index}", daemon=True).start()
+
+    def submit(self, bot, chat_id, reply_to_message_id, export_format='csv'):
+        """
+        Ставит выгрузку в очередь и сразу возвращает управление
+
+        :param bot: TeleBot или AsyncBotBridge
+        :param chat_id:
+        :param reply_to_message_id: Сообщение с командой, ответом на него придёт файл
+        :param export_format: csv или jsonl
+        :return:
+        """
+        job = ExportJob(bot, chat_id, reply_to_message_id, export_format)
+        if self.running:
+            self.jobs.put(job)
+        elif isinstance(bot, AsyncBotBridge):
+            # Обработчик работает внутри event loop: выгрузка идёт отдельной задачей в нём же
+            task = asyncio.get_running_loop().create_task(greenlet_spawn(self.run_job, job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            # Фоновые потоки не запущены (скрипты) - выгружаем сразу
+            self.run_job(job)
+
+    def worker(self):
+        while True:
+            self.run_job(self.jobs.get())
+
+    def run_job(self, job):
+        try:
+            # У выгрузки своя сессия: её курсор не должен мешать сессии обработчика
+            with unit_of_work():
+                self.export(job)
+        except Exception as e:
+            log_error(f"export {job.chat_id} {str(e)}")
+
+    def export(self, job):
+        file = SpooledTemporaryFile(max_size=self.spool_size, mode='w+b')
+        try:
+            text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+            rows_count = self.write(text, iter_chat_history(job.chat_id, self.batch_size), job.export_format)
+            text.flush()
+            text.detach()
+        except Exception:
+            file.close()
+            raise
+
+        # Файл и сообщения отправляются через общую очередь, с её лимитами и повтором после 429
+        if not rows_count:
+            file.close()
+            outbound_scheduler.submit(job.chat_id, PRIORITY_INTERACTIVE, job.bot.send_message, job.chat_id,
+                                      get_export_empty_message(), reply_to_message_id=job.reply_to_message_id)
+            return
+
+        def send_document():
+            # При повторе после 429 файл отправляется с начала
+            file.seek(0)
+            try:
+                job.bot.send_document(job.chat_id,
+                                      InputFile(file, file_name=f"history_{job.chat_id}.{job.export_format}"),
+                                      reply_to_message_id=job.reply_to_message_id, caption=f"Записей: {rows_count}")
+            except (ApiTelegramException, AsyncApiTelegramException) as e:
+                if e.error_code != 429:
+                    file.close()
+                raise
+            file.close()
+
+        outbound_scheduler.submit(job.chat_id, PRIORITY_INTERACTIVE, send_document)
+
+    @staticmethod
+    def write(text, rows, export_format):
+        """
+        Пишет строки истории в файл построчно
+
+        :param text: Текстовый файл
+        :param rows: Строки из iter_chat_history
+        :param export_format: csv или jsonl
+        :return: Кол-во записанных строк
+        """
+        rows_count = 0
+        if export_format == 'jsonl':
+            for row in rows:
+                item = dict(zip(EXPORT_COLUMNS, row))
+                item['created_at'] = item['created_at'].isoformat() if item['created_at'] else None
+                text.write(json.dumps(item, ensure_ascii=False) + '\n')
+                rows_count += 1
+            return rows_count
+
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            rows_count += 1
+        return rows_count
+
+
+chat_exporter = ChatExporter(workers=int(env_variables.get('EXPORT_WORKERS') or 1),
+                             spool_size=int(env_variables.get('EXPORT_SPOOL_SIZE') or 8 * 1024 * 1024),
+                             batch_size=int(env_variables.get('EXPORT_BATCH_SIZE') or 1000))
@@ -0,0 +1,221 @@
+import threading
+import time
+from datetime import timedelta
+from sortedcontainers import SortedList
+from sqlalchemy import func, and_
+from app.models import User, Chat, UserScore, Message
+from config.db import session
+from lib.classes.AutoRefreshTTLCache import AutoRefreshTTLCache
+from lib.cache import invalidation_bus
+from lib.helpers import env_variables
+
+
+class LeaderboardEntry:
+    __slots__ = ('user_id', 'username', 'score', 'added', 'subtracted')
+
+    def __init__(self, user_id, username, score, added, subtracted):
+        self.user_id = user_id
+        self.username = username
+        self.score = score or 0
+        self.added = added or 0
+        self.subtracted = subtracted or 0
+
+
+class ChatLeaderboard:
+    """
+    Рейтинг одного чата: пользователи упорядочены по (счёт по убыванию, id).
+    Топ-N и место пользователя считаются за O(log n) без обращения к БД
+    """
+
+    def __init__(self, entries, last_message_id=0, seq=None):
+        """
+        :param entries: Список LeaderboardEntry
+        :param last_message_id: Наибольший id в messages после чтения счёта: начисления с большим id
+            в загруженный счёт точно не вошли
+        :param seq: Номер последнего изменения чата на шине до чтения счёта, None - неизвестен
+        """
+        self.lock = threading.Lock()
+        self.last_message_id = last_message_id or 0
+        self.seq = seq
+        self.loaded_at = time.monotonic()
+        self.entries = {entry.user_id: entry for entry in entries}
+        self.order = SortedList((-entry.score, entry.user_id) for entry in entries)
+
+    def size(self):
+        return len(self.entries)
+
+    def get(self, user_id):
+        return self.entries.get(user_id)
+
+    def top(self, count):
+        with self.lock:
+            return [self.entries[user_id] for _, user_id in self.order[:count]]
+
+    def rank(self, user_id):
+        """
+        Место пользователя в рейтинге, начиная с 1, или None если его нет
+
+        :param user_id:
+        :return:
+        """
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            return self.order.index((-entry.score, user_id)) + 1
+
+    def apply(self, users, points):
+        """
+        Применяет изменение баллов к пользователям
+
+        :param users: Список (id, username)
+        :param points:
+        :return:
+        """
+        with self.lock:
+            for user_id, username in users:
+                entry = self.entries.get(user_id)
+                if entry is None:
+                    entry = LeaderboardEntry(user_id, username, 0, 0, 0)
+                    self.entries[user_id] = entry
+                else:
+                    self.order.remove((-entry.score, user_id))
+
+                entry.score += points
+                if points > 0:
+                    entry.added += points
+                else:
+                    entry.subtracted += points
+                self.order.add((-entry.score, user_id))
+
+    def reset(self):
+        with self.lock:
+            for entry in self.entries.values():
+                entry.score = entry.added = entry.subtracted = 0
+            self.order = SortedList((0, user_id) for user_id in self.entries)
+
+
+class Leaderboards:
+    """
+    Рейтинги чатов в памяти. Чат загружается одним запросом при первом обращении
+    и выгружается, если к нему долго не обращались или он старше max_age. Изменения баллов
+    другие процессы бота применяют к своей копии по порядку номеров, при пропуске номера,
+    после сброса сезона и новых участников выбрасывают чат
+    """
+
+    def __init__(self, maxsize, idle_ttl, max_age):
+        self.boards = AutoRefreshTTLCache(maxsize=maxsize, ttl=idle_ttl)
+        self.max_age = max_age
+        invalidation_bus.subscribe('leaderboard', self.drop)
+        invalidation_bus.subscribe('leaderboard_delta', self.apply_delta, sequenced=True)
+
+    def get(self, chat_id):
+        key = str(chat_id)
+        # Одновременные обращения к ещё не загруженному чату ждут одну загрузку
+        board = self.boards.get_or_load(key, lambda: self.load_board(key))
+        if time.monotonic() - board.loaded_at > self.max_age:
+            # Чтение продлевает жизнь чата, поэтому активный чат раз в max_age сверяется с БД
+            self.boards.delete(key)
+            board = self.boards.get_or_load(key, lambda: self.load_board(key))
+        return board
+
+    def load_board(self, chat_id):
+        # Номер берётся до чтения счёта: изменения с номером не больше уже есть в БД
+        seq = invalidation_bus.get_sequence('leaderboard_delta', chat_id)
+        entries = self.load(chat_id)
+        return ChatLeaderboard(entries, self.get_last_message_id(), seq)
+
+    def apply(self, chat_id, users, points, message_id):
+        """
+        :param chat_id:
+        :param users: Список (id, username)
+        :param points:
+        :param message_id: id одной из записей messages этого изменения
+        :return:
+        """
+        key = str(chat_id)
+        board = self.boards.get(key)
+        if board is None or message_id <= board.last_message_id:
+            # Загрузка, которая идёт сейчас или только что прошла, могла уже прочитать изменение - не сохраняем её
+            self.boards.delete(key)
+        else:
+            board.apply(users, points)
+        # Остальные процессы применяют то же изменение к своей копии, без перезагрузки чата.
+        # Если изменение не удалось отправить, они выбрасывают чат
+        invalidation_bus.publish('leaderboard_delta', {'chat_id': key, 'users': users, 'points': points,
+                                                       'message_id': message_id},
+                                 sequence_key=key, fallback=('leaderboard', key))
+
+    def reset(self, chat_id):
+        board = self.boards.get(str(chat_id))
+        if board is None:
+            self.boards.delete(str(chat_id))
+        else:
+            board.reset()
+        self.notify_changed(chat_id)
+
+    def invalidate(self, chat_id):
+        self.boards.delete(str(chat_id))
+        self.notify_changed(chat_id)
+
+    @staticmethod
+    def notify_changed(chat_id):
+        invalidation_bus.publish('leaderboard', str(chat_id))
+
+    def drop(self, chat_id):
+        # Сообщение от другого процесса, дальше не публикуем
+        if chat_id is None:
+            self.boards.clear()
+        else:
+            self.boards.delete(chat_id)
+
+    def apply_delta(self, delta, seq, own):
+        """
+        Изменение баллов с шины, дальше не публикуем. Свои изменения тоже приходят,
+        чтобы номера шли подряд, но уже применены в apply
+
+        :param delta: Словарь chat_id, users (список [id, username]), points, message_id или None - выбросить всё
+        :param seq: Номер изменения в чате
+        :param own: Изменение отправил этот процесс
+        :return:
+        """
+        if delta is None:
+            self.boards.clear()
+            return
+        key = delta['chat_id']
+        board = self.boards.get(key)
+        if board is None:
+            if not own:
+                # Загрузка, которая идёт сейчас, могла прочитать счёт до изменения - не сохраняем её
+                self.boards.delete(key)
+            return
+
+        with board.lock:
+            if board.seq is not None and seq <= board.seq:
+                # Изменение было в БД до загрузки
+                return
+            # Номер неизвестен или пропущен - изменение потерялось по дороге
+            missed = board.seq is None or seq != board.seq + 1
+            board.seq = seq
+        if missed or (not own and delta['message_id'] <= board.last_message_id):
+            # Счёт мог разойтись с БД или уже содержать это изменение
+            self.boards.delete(key)
+        elif not own:
+            board.apply(delta['users'], delta['points'])
+
+    @staticmethod
+    def get_last_message_id():
+        return session.query(func.max(Message.id)).scalar() or 0
+
+    @staticmethod
+    def load(chat_id):
+        rows = session.query(User.id, User.username, UserScore.score, UserScore.added, UserScore.subtracted) \
+            .outerjoin(Chat, Chat.chat_id == User.chat_id) \
+            .outerjoin(UserScore, and_(UserScore.user_id == User.id, UserScore.epoch == func.coalesce(Chat.epoch, 1))) \
+            .filter(User.chat_id == chat_id)
+        return [LeaderboardEntry(*row) for row in rows]
+
+
+leaderboards = Leaderboards(maxsize=int(env_variables.get('LEADERBOARD_MAX_CHATS') or 1000),
+                            idle_ttl=float(env_variables.get('LEADERBOARD_IDLE_TTL') or timedelta(minutes=30).total_seconds()),
+                            max_age=float(env_variables.get('LEADERBOARD_MAX_AGE') or timedelta(minutes=10).total_seconds()))
@@ -0,0 +1,141 @@
+import threading
+from bisect import bisect_left
+
+# Границы корзин гистограмм по умолчанию, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class CounterMetric:
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name, format_labels(self.label_names, labels), value) for labels, value in values]
+
+
+class HistogramMetric:
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # Значения меток -> [кол-во по корзинам (последняя - +Inf), сумма]
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket",
+                                format_labels(self.label_names, labels, [('le', format_value(bound))]), cumulative))
+            samples.append((f"{self.name}_sum", format_labels(self.label_names, labels), total))
+            samples.append((f"{self.name}_count", format_labels(self.label_names, labels), cumulative))
+        return samples
+
+
+class GaugeMetric:
+    """
+    Значение, которое считается в момент запроса метрик, например длина очереди
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def samples(self):
+        return [(self.name, '', self.func())]
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса в текстовом формате Prometheus. Без зависимостей: счётчики, гистограммы
+    и вычисляемые значения, всё потокобезопасно
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(CounterMetric(name, documentation, tuple(label_names)))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(HistogramMetric(name, documentation, tuple(label_names), buckets))
+
+    def gauge(self, name, documentation, func):
+        return self.register(GaugeMetric(name, documentation, func))
+
+    def render(self):
+        """
+        Все метрики в формате text/plain; version=0.0.4
+
+        :return:
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                # Вычисляемое значение не получилось - пропускаем, остальные метрики важнее
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,262 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from sqlalchemy.util import greenlet_spawn
+from telebot.apihelper import ApiTelegramException
+from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException
+from lib.errors import log_error
+from lib.helpers import env_variables
+
+# Приоритеты исходящих сообщений: меньше - раньше
+PRIORITY_INTERACTIVE = 0  # ответы на команды
+PRIORITY_FLAVOR = 1  # реакции на изменение баллов
+
+# Сколько раз повторяем отправку после 429 Too Many Requests
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # До этого момента Telegram просил не отправлять (retry_after)
+        self.blocked_until = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Через сколько секунд можно будет отправить сообщение, 0 - можно сейчас
+
+        :param now:
+        :return:
+        """
+        self.refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class OutboundJob:
+    __slots__ = ('chat_id', 'func', 'args', 'kwargs', 'attempts')
+
+    def __init__(self, chat_id, func, args, kwargs):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+
+
+class OutboundScheduler:
+    """
+    Очередь исходящих сообщений с ограничением скорости.
+    Общий token bucket держит глобальный лимит Telegram, у каждого чата свой bucket.
+    Ответы на команды отправляются раньше реакций на баллы, 429 повторяется через retry_after.
+    Сообщения одного чата отправляются по одному, так что порядок внутри приоритета сохраняется.
+    В синхронном режиме отправляют потоки (start), в асинхронном - задачи event loop (start_async)
+    """
+
+    def __init__(self, global_rate, group_per_minute, private_rate, senders):
+        self.group_per_minute = group_per_minute
+        self.private_rate = private_rate
+        self.senders = senders
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.pending = {}  # chat_id -> куча (priority, seq, job)
+        self.in_flight = set()
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        # Будит отправителей асинхронного режима, None - очередь работает на потоках
+        self.wakeup = None
+        # Ссылки на задачи отправителей, иначе их может собрать сборщик мусора
+        self.tasks = []
+
+    def start(self):
+        self.running = True
+        for index in range(self.senders):
+            threading.Thread(target=self.sender, name=f"outbound-sender-{index}", daemon=True).start()
+
+    def start_async(self):
+        """
+        Запускает отправителей задачами текущего event loop. Очередь и bucket'ы те же,
+        вызовы AsyncBotBridge выполняются через greenlet_spawn
+
+        :return:
+        """
+        self.running = True
+        self.wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(self.async_sender()) for _ in range(self.senders)]
+
+    def submit(self, chat_id, priority, func, *args, **kwargs):
+        """
+        Ставит вызов метода бота в очередь и сразу возвращает управление.
+        Если очередь не запущена (скрипты), вызов выполняется сразу
+
+        :param chat_id: Чат, в который отправляется сообщение
+        :param priority: PRIORITY_INTERACTIVE или PRIORITY_FLAVOR
+        :param func: Метод бота, например bot.reply_to
+        :return:
+        """
+        if not self.running:
+            return func(*args, **kwargs)
+
+        with self.cond:
+            self.push(priority, next(self.seq), OutboundJob(chat_id, func, args, kwargs))
+
+    def push(self, priority, seq, job):
+        heapq.heappush(self.pending.setdefault(job.chat_id, []), (priority, seq, job))
+        self.cond.notify()
+        if self.wakeup is not None:
+            # submit в асинхронном режиме вызывается из greenlet в потоке event loop
+            self.wakeup.set()
+
+    def size(self):
+        with self.cond:
+            return sum(len(jobs) for jobs in self.pending.values())
+
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                # Группы: не больше group_per_minute сообщений в минуту
+                bucket = TokenBucket(self.group_per_minute / 60, self.group_per_minute)
+            else:
+                bucket = TokenBucket(self.private_rate, 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def pick(self, now):
+        """
+        Выбирает чат, чьё сообщение отправить следующим
+
+        :param now:
+        :return: Кортеж (chat_id или None, сколько ждать до следующей попытки или None)
+        """
+        best_chat_id = None
+        best_key = None
+        timeout = None
+        for chat_id, jobs in self.pending.items():
+            if chat_id in self.in_flight:
+                continue
+            key = jobs[0][:2]
+            if best_key is not None and key >= best_key:
+                continue
+            wait = self.get_chat_bucket(chat_id).wait_time(now)
+            if wait > 0:
+                timeout = wait if timeout is None else min(timeout, wait)
+                continue
+            best_chat_id, best_key = chat_id, key
+        return best_chat_id, timeout
+
+    def take_job(self, chat_id):
+        jobs = self.pending[chat_id]
+        priority, seq, job = heapq.heappop(jobs)
+        if not jobs:
+            del self.pending[chat_id]
+        self.global_bucket.take()
+        self.get_chat_bucket(chat_id).take()
+        self.in_flight.add(chat_id)
+        return priority, seq, job
+
+    def sender(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    global_wait = self.global_bucket.wait_time(now)
+                    if global_wait > 0:
+                        self.cond.wait(global_wait)
+                        continue
+                    chat_id, timeout = self.pick(now)
+                    if chat_id is not None:
+                        break
+                    self.cond.wait(timeout)
+
+                priority, seq, job = self.take_job(chat_id)
+
+            try:
+                self.send(priority, seq, job)
+            finally:
+                with self.cond:
+                    self.in_flight.discard(chat_id)
+                    self.forget_idle_buckets()
+                    self.cond.notify_all()
+
+    async def async_sender(self):
+        while True:
+            # Все отправители работают в потоке event loop, блокировка здесь никогда не ждёт
+            with self.cond:
+                now = time.monotonic()
+                timeout = self.global_bucket.wait_time(now)
+                chat_id = None
+                if timeout <= 0:
+                    chat_id, timeout = self.pick(now)
+                if chat_id is not None:
+                    priority, seq, job = self.take_job(chat_id)
+
+            if chat_id is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await greenlet_spawn(self.send, priority, seq, job)
+            except Exception as e:
+                log_error(f"outbound {job.chat_id} {str(e)}")
+            finally:
+                with self.cond:
+                    self.in_flight.discard(chat_id)
+                    self.forget_idle_buckets()
+                self.wakeup.set()
+
+    def send(self, priority, seq, job):
+        try:
+            job.func(*job.args, **job.kwargs)
+        except (ApiTelegramException, AsyncApiTelegramException) as e:
+            if e.error_code != 429 or job.attempts >= MAX_RETRIES:
+                log_error(f"outbound {job.chat_id} {str(e)}")
+                return
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+            with self.cond:
+                # Чат блокируем на retry_after, сообщение возвращаем на его место в очереди
+                self.get_chat_bucket(job.chat_id).blocked_until = time.monotonic() + retry_after
+                job.attempts += 1
+                self.push(priority, seq, job)
+        except Exception as e:
+            log_error(f"outbound {job.chat_id} {str(e)}")
+
+    def forget_idle_buckets(self):
+        # Не храним bucket'ы чатов, которые давно ничего не отправляли
+        if len(self.chat_buckets) < 10000:
+            return
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items()
+                        if chat_id not in self.pending and chat_id not in self.in_flight and bucket.is_idle(now)]:
+            del self.chat_buckets[chat_id]
+
+
+outbound_scheduler = OutboundScheduler(global_rate=float(env_variables.get('OUTBOUND_GLOBAL_RATE') or 30),
+                                       group_per_minute=float(env_variables.get('OUTBOUND_GROUP_PER_MINUTE') or 20),
+                                       private_rate=float(env_variables.get('OUTBOUND_PRIVATE_RATE') or 1),
+                                       senders=int(env_variables.get('OUTBOUND_SENDERS') or 4))
@@ -0,0 +1,16 @@
+class ParsedVote:
+    """
+    Изменение баллов, найденное в тексте сообщения:
+    кому (username и пользователи без username из text_mention), на сколько и с каким комментарием
+    """
+    __slots__ = ('usernames', 'text_mentions', 'delta', 'comment')
+
+    def __init__(self, usernames, text_mentions, delta, comment):
+        self.usernames = usernames
+        # Список (telegram_user_id, имя) из text_mention
+        self.text_mentions = text_mentions
+        self.delta = delta
+        self.comment = comment
+
+    def __repr__(self):
+        return f"ParsedVote({self.usernames!r}, {self.text_mentions!r}, {self.delta!r}, {self.comment!r})"
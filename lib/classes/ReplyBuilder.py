@@ -0,0 +1,22 @@
+from lib.classes.OutboundScheduler import outbound_scheduler, PRIORITY_FLAVOR
+
+
+class ReplyBuilder:
+    """
+    Собирает все ответы на одно входящее сообщение и отправляет их одним сообщением,
+    вместо отдельного reply_to на каждый результат
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def add(self, text):
+        if text:
+            self.parts.append(text)
+
+    def text(self):
+        return "\n\n".join(self.parts)
+
+    def send(self, bot, message, priority=PRIORITY_FLAVOR):
+        if self.parts:
+            outbound_scheduler.submit(message.chat.id, priority, bot.reply_to, message, self.text())
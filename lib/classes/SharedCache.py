@@ -0,0 +1,429 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from lib.classes.AutoRefreshTTLCache import AutoRefreshTTLCache
+from lib.classes.CacheBackend import CacheBackend, Flight, MISSING
+from lib.errors import log_error
+
+# Сколько последних инвалидаций ключей помнит сервер, чтобы отклонять устаревшие загрузки
+INVALIDATIONS_LIMIT = 100000
+
+# Не чаще раза в столько секунд пишем в лог, что сервер кэша недоступен
+ERROR_LOG_INTERVAL = 60
+
+
+def decode_key(key):
+    # Кортежи в JSON приходят списками
+    return tuple(key) if isinstance(key, list) else key
+
+
+class CacheServer:
+    """
+    Общий кэш для процессов бота на одном сервере, доступен через unix socket.
+    Хранит значения по видам данных в AutoRefreshTTLCache и рассылает подписчикам сообщения инвалидации.
+    Загрузка, во время которой ключ изменили, не сохраняется: при промахе клиент получает lease,
+    а запись по нему принимается, только если с тех пор ключ никто не менял
+    """
+
+    def __init__(self, socket_path, namespaces):
+        """
+        :param socket_path: Путь к unix socket
+        :param namespaces: Словарь вид данных -> (maxsize, ttl, negative_ttl)
+        """
+        self.socket_path = socket_path
+        self.namespaces = namespaces
+        self.caches = {}
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.invalidated = OrderedDict()  # (вид данных, ключ) -> номер последнего изменения
+        # Изменения, вытесненные из invalidated, были не позже этого номера
+        self.forgotten_before = 0
+        self.subscribers = {}  # wfile -> (token, lock, connection)
+        # Номера последних сообщений по (канал, ключ) для каналов, где важно не потерять ни одного
+        self.sequences = {}
+
+    def get_cache(self, namespace):
+        cache = self.caches.get(namespace)
+        if cache is None:
+            maxsize, ttl, negative_ttl = self.namespaces.get(namespace, (10000, 3600, None))
+            cache = self.caches[namespace] = AutoRefreshTTLCache(maxsize=maxsize, ttl=ttl, negative_ttl=negative_ttl)
+        return cache
+
+    def invalidate(self, namespace, key):
+        self.counter += 1
+        self.invalidated[(namespace, key)] = self.counter
+        self.invalidated.move_to_end((namespace, key))
+        if len(self.invalidated) > INVALIDATIONS_LIMIT:
+            _, self.forgotten_before = self.invalidated.popitem(last=False)
+
+    def handle(self, message):
+        """
+        Выполняет запрос клиента
+
+        :param message: Словарь запроса
+        :return: Словарь ответа
+        """
+        op = message['op']
+        if op == 'publish':
+            self.publish(message)
+            return {'ok': True}
+        if op == 'sequence':
+            with self.lock:
+                return {'seq': self.sequences.get((message['channel'], message['sequence_key']), 0)}
+
+        namespace = message.get('ns')
+        key = decode_key(message.get('key'))
+        with self.lock:
+            cache = self.get_cache(namespace) if namespace else None
+            if op == 'get':
+                value = cache.get(key, MISSING)
+                if value is MISSING:
+                    return {'hit': False, 'lease': self.counter}
+                return {'hit': True, 'value': value}
+            if op == 'fill':
+                last_change = self.invalidated.get((namespace, key), self.forgotten_before)
+                if last_change > message['lease']:
+                    return {'ok': False}
+                if message.get('negative'):
+                    cache.set_negative(key, message.get('value'))
+                else:
+                    cache.set(key, message.get('value'))
+                return {'ok': True}
+            if op in ('set', 'set_negative', 'delete'):
+                self.invalidate(namespace, key)
+                if op == 'set':
+                    cache.set(key, message.get('value'))
+                elif op == 'set_negative':
+                    cache.set_negative(key, message.get('value'))
+                else:
+                    cache.delete(key)
+                return {'ok': True}
+            if op == 'clear':
+                self.counter += 1
+                self.forgotten_before = self.counter
+                self.invalidated.clear()
+                cache.clear()
+                return {'ok': True}
+        return {'error': f"unknown op {op}"}
+
+    def publish(self, message):
+        """
+        Рассылает сообщение подписчикам. Сообщения с sequence_key нумеруются по ключу и приходят
+        и отправителю, чтобы у каждого подписчика номера шли подряд, а пропуск было видно
+
+        :param message:
+        :return:
+        """
+        payload = {'channel': message['channel'], 'key': message.get('key')}
+        sequence_key = message.get('sequence_key')
+        with self.lock:
+            if sequence_key is not None:
+                seq_key = (message['channel'], sequence_key)
+                payload['seq'] = self.sequences[seq_key] = self.sequences.get(seq_key, 0) + 1
+                payload['token'] = message.get('token')
+            subscribers = list(self.subscribers.items())
+
+        line = json.dumps(payload).encode('utf-8') + b'\n'
+        for wfile, (token, lock, connection) in subscribers:
+            # Отправителю его же инвалидация не нужна
+            if sequence_key is None and token == message.get('token'):
+                continue
+            try:
+                with lock:
+                    wfile.write(line)
+                    wfile.flush()
+            except OSError:
+                # Подписчик пропустил сообщение: закрываем соединение, после переподключения он выбросит всё
+                self.unsubscribe(wfile)
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def subscribe(self, wfile, token, connection):
+        with self.lock:
+            self.subscribers[wfile] = (token, threading.Lock(), connection)
+
+    def unsubscribe(self, wfile):
+        with self.lock:
+            self.subscribers.pop(wfile, None)
+
+    def make_handler(self):
+        cache_server = self
+
+        class CacheRequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        return
+                    if message.get('op') == 'subscribe':
+                        cache_server.subscribe(self.wfile, message.get('token'), self.connection)
+                        try:
+                            # Подписчик только слушает, ждём закрытия соединения
+                            for _ in self.rfile:
+                                pass
+                        finally:
+                            cache_server.unsubscribe(self.wfile)
+                        return
+                    try:
+                        response = cache_server.handle(message)
+                    except Exception as e:
+                        response = {'error': str(e)}
+                    self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+
+        return CacheRequestHandler
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, self.make_handler())
+        server.daemon_threads = True
+        # Доступ к кэшу только у пользователя, от которого запущен бот
+        os.chmod(self.socket_path, 0o600)
+        server.serve_forever()
+
+
+class SharedCacheClient:
+    """
+    Соединение с CacheServer. У каждого потока своё соединение; в асинхронном режиме все greenlet'ы
+    потока делят одно, запрос и ответ идут без переключения. Если сервер недоступен,
+    запросы возвращают None, и кэш работает как промах
+    """
+
+    def __init__(self, socket_path, timeout):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+        # Метка процесса: свои сообщения инвалидации он не получает
+        self.token = uuid.uuid4().hex
+        self.error_logged_at = 0
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock, sock.makefile('rwb')
+
+    def request(self, message):
+        connection = getattr(self.local, 'connection', None)
+        try:
+            if connection is None:
+                connection = self.local.connection = self.connect()
+            file = connection[1]
+            file.write(json.dumps(message).encode('utf-8') + b'\n')
+            file.flush()
+            line = file.readline()
+            if not line:
+                raise ConnectionError("cache server closed connection")
+            return json.loads(line)
+        except (OSError, ValueError) as e:
+            self.close()
+            self.log_failure(e)
+            return None
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection is not None:
+            try:
+                connection[0].close()
+            except OSError:
+                pass
+
+    def log_failure(self, error):
+        now = time.monotonic()
+        if now - self.error_logged_at >= ERROR_LOG_INTERVAL:
+            self.error_logged_at = now
+            log_error(f"shared cache {self.socket_path} {str(error)}")
+
+
+class SharedCacheBackend(CacheBackend):
+    """
+    Вид данных в общем кэше процессов. Значения должны сериализоваться в JSON.
+    Одновременные промахи внутри процесса ждут одну загрузку, как в AutoRefreshTTLCache
+    """
+
+    def __init__(self, client, namespace):
+        self.client = client
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def lookup(self, key):
+        response = self.client.request({'op': 'get', 'ns': self.namespace, 'key': key})
+        if response is None:
+            return MISSING, None
+        if response.get('hit'):
+            return response['value'], None
+        return MISSING, response.get('lease')
+
+    def get(self, key, default=None):
+        value, _ = self.lookup(key)
+        return default if value is MISSING else value
+
+    def set(self, key, value):
+        self.client.request({'op': 'set', 'ns': self.namespace, 'key': key, 'value': value})
+
+    def set_negative(self, key, value=None):
+        self.client.request({'op': 'set_negative', 'ns': self.namespace, 'key': key, 'value': value})
+
+    def delete(self, key):
+        self.client.request({'op': 'delete', 'ns': self.namespace, 'key': key})
+
+    def clear(self):
+        self.client.request({'op': 'clear', 'ns': self.namespace})
+
+    def get_or_load(self, key, loader):
+        value, lease = self.lookup(key)
+        if value is not MISSING:
+            return value
+
+        flight_key = json.dumps(key)
+        with self.lock:
+            flight = self.flights.get(flight_key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self.flights[flight_key] = Flight()
+
+        if not is_leader:
+            value = flight.wait()
+            return loader() if value is MISSING else value
+
+        try:
+            value = loader()
+        except BaseException as e:
+            flight.finish(error=e)
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(flight_key, None)
+
+        if lease is not None:
+            # Сервер не сохранит значение, если ключ успели изменить после промаха
+            self.client.request({'op': 'fill', 'ns': self.namespace, 'key': key, 'value': value,
+                                 'negative': value is None, 'lease': lease})
+        flight.finish(value)
+        return value
+
+
+class InvalidationBus:
+    """
+    Сообщения об изменениях между процессами: процесс, изменивший данные чата,
+    публикует их, остальные выбрасывают или обновляют свою копию в памяти. Без клиента общего кэша
+    (один процесс) ничего не делает. После start сообщения отправляет фоновый поток,
+    чтобы обработчики, в том числе в event loop асинхронного режима, не ждали сервер кэша
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+        self.callbacks = {}  # канал -> список (функция, нумерованный ли канал)
+        self.outbox = queue.Queue()
+        self.running = False
+
+    def subscribe(self, channel, callback, sequenced=False):
+        """
+        :param channel: Например user_directory
+        :param callback: Функция от данных сообщения, None - выбросить всё.
+            Для нумерованного канала - функция (данные, номер, своё ли сообщение)
+        :param sequenced: Сообщения канала нумеруются сервером и приходят и отправителю
+        :return:
+        """
+        self.callbacks.setdefault(channel, []).append((callback, sequenced))
+
+    def publish(self, channel, key, sequence_key=None, fallback=None):
+        """
+        :param channel:
+        :param key: Данные сообщения, сериализуемые в JSON, обычно str(chat_id)
+        :param sequence_key: Ключ нумерации, например str(chat_id) - тогда подписчики видят пропуски
+        :param fallback: (канал, данные), которые отправить, если само сообщение отправить не удалось
+        :return:
+        """
+        if self.client is None:
+            return
+        message = {'op': 'publish', 'channel': channel, 'key': key, 'token': self.client.token}
+        if sequence_key is not None:
+            message['sequence_key'] = sequence_key
+        if self.running:
+            self.outbox.put((message, fallback))
+        else:
+            # Фоновый поток не запущен (скрипты manage.py) - отправляем сразу
+            self.deliver(message, fallback)
+
+    def get_sequence(self, channel, sequence_key):
+        """
+        Номер последнего сообщения нумерованного канала
+
+        :return: Номер или None, если сервер недоступен
+        """
+        if self.client is None:
+            return None
+        response = self.client.request({'op': 'sequence', 'channel': channel, 'sequence_key': sequence_key})
+        return response['seq'] if response else None
+
+    def start(self):
+        if self.client is None:
+            return
+        self.running = True
+        threading.Thread(target=self.listen, name="cache-invalidation", daemon=True).start()
+        threading.Thread(target=self.send, name="cache-invalidation-sender", daemon=True).start()
+
+    def send(self):
+        while True:
+            self.deliver(*self.outbox.get())
+
+    def deliver(self, message, fallback=None):
+        if self.client.request(message) is not None or fallback is None:
+            return
+        # Изменение до других процессов не дошло - просим их выбросить данные целиком.
+        # Если сервер недоступен совсем, подписчики переподключатся и выбросят всё сами
+        channel, key = fallback
+        for _ in range(3):
+            if self.client.request({'op': 'publish', 'channel': channel, 'key': key,
+                                    'token': self.client.token}) is not None:
+                return
+            time.sleep(0.1)
+
+    def notify(self, channel, message):
+        """
+        :param channel:
+        :param message: Сообщение сервера или None - выбросить всё
+        :return:
+        """
+        for callback, sequenced in self.callbacks.get(channel, []):
+            try:
+                if not sequenced:
+                    callback(message['key'] if message else None)
+                elif message is None:
+                    callback(None, None, False)
+                else:
+                    callback(message['key'], message['seq'], message.get('token') == self.client.token)
+            except Exception as e:
+                log_error(f"cache invalidation {channel} {str(e)}")
+
+    def listen(self):
+        while True:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.client.socket_path)
+                with sock, sock.makefile('rwb') as file:
+                    file.write(json.dumps({'op': 'subscribe', 'token': self.client.token}).encode('utf-8') + b'\n')
+                    file.flush()
+                    for line in file:
+                        message = json.loads(line)
+                        self.notify(message['channel'], message)
+            except (OSError, ValueError) as e:
+                self.client.log_failure(e)
+
+            # Пока не были подписаны, сообщения могли потеряться - выбрасываем всё
+            for channel in self.callbacks:
+                self.notify(channel, None)
+            time.sleep(1)
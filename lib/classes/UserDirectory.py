@@ -0,0 +1,154 @@
+import threading
+from datetime import timedelta
+from sqlalchemy import func, and_
+from app.models import User, Chat, UserScore
+from config.db import session
+from lib.classes.AutoRefreshTTLCache import AutoRefreshTTLCache
+from lib.cache import invalidation_bus
+from lib.helpers import env_variables
+
+
+class UserRecord:
+    __slots__ = ('id', 'telegram_user_id', 'username', 'is_manager', 'score')
+
+    def __init__(self, id, telegram_user_id, username, is_manager, score):
+        # id = None: пользователь ещё ждёт записи в буфере регистрации
+        self.id = id
+        self.telegram_user_id = int(telegram_user_id)
+        self.username = username
+        self.is_manager = bool(is_manager)
+        self.score = score or 0
+
+
+class ChatDirectory:
+    """
+    Пользователи одного чата. Одна и та же запись доступна по username и по telegram_user_id,
+    username сравнивается без учёта регистра, как в Telegram и MySQL
+    """
+
+    def __init__(self, records):
+        self.lock = threading.Lock()
+        self.by_username = {}
+        self.by_telegram_user_id = {}
+        for record in records:
+            self.put(record)
+
+    def put(self, record):
+        current = self.by_telegram_user_id.get(record.telegram_user_id)
+        if current is not None and current.username and self.by_username.get(current.username.lower()) is current:
+            del self.by_username[current.username.lower()]
+        self.by_telegram_user_id[record.telegram_user_id] = record
+        if record.username:
+            # Если username в чате встречается дважды, остаётся первая запись
+            self.by_username.setdefault(record.username.lower(), record)
+
+    def add(self, record):
+        with self.lock:
+            current = self.by_telegram_user_id.get(record.telegram_user_id)
+            if current is None:
+                self.put(record)
+            elif current.id is None and record.id is not None:
+                # Пользователь записан в БД, проставляем id
+                current.id = record.id
+
+    def find_by_username(self, username):
+        return self.by_username.get(username.lower()) if username else None
+
+    def find_by_telegram_user_id(self, telegram_user_id):
+        return self.by_telegram_user_id.get(int(telegram_user_id))
+
+    def resolve(self, usernames=(), telegram_user_ids=()):
+        """
+        Находит пользователей чата по username и telegram_user_id, каждого не больше одного раза
+
+        :param usernames:
+        :param telegram_user_ids:
+        :return: Список UserRecord в порядке упоминания
+        """
+        records = []
+        for record in [self.find_by_username(username) for username in usernames] + \
+                      [self.find_by_telegram_user_id(telegram_user_id) for telegram_user_id in telegram_user_ids]:
+            if record is not None and record not in records:
+                records.append(record)
+        return records
+
+    def apply(self, records, points):
+        with self.lock:
+            for record in records:
+                record.score += points
+
+    def reset(self):
+        with self.lock:
+            for record in self.by_telegram_user_id.values():
+                record.score = 0
+
+
+class UserDirectory:
+    """
+    Справочник пользователей чатов в памяти. Чат загружается одним запросом при первом обращении,
+    после этого пользователь события находится в памяти один раз, без отдельных запросов
+    на проверку существования, id, telegram_user_id и права менеджера.
+    Чаты, к которым долго не обращались, выгружаются. У каждого процесса бота свой справочник:
+    изменив чат, процесс сообщает об этом остальным, и они загружают чат заново
+    """
+
+    def __init__(self, maxsize, idle_ttl):
+        self.chats = AutoRefreshTTLCache(maxsize=maxsize, ttl=idle_ttl)
+        invalidation_bus.subscribe('user_directory', self.drop)
+
+    def get(self, chat_id):
+        key = str(chat_id)
+        # Одновременные обращения к ещё не загруженному чату ждут одну загрузку
+        return self.chats.get_or_load(key, lambda: ChatDirectory(self.load(key)))
+
+    def add(self, chat_id, record):
+        # Чат подгружаем заранее, чтобы ещё не записанный в БД пользователь не потерялся при загрузке
+        self.get(chat_id).add(record)
+
+    def set_manager(self, chat_id, telegram_user_id, is_manager):
+        directory = self.chats.get(str(chat_id))
+        if directory is None:
+            # Загрузка, которая идёт сейчас, могла прочитать старое значение - не сохраняем её
+            self.chats.delete(str(chat_id))
+        else:
+            record = directory.find_by_telegram_user_id(telegram_user_id)
+            if record is not None:
+                record.is_manager = is_manager
+        self.notify_changed(chat_id)
+
+    def reset(self, chat_id):
+        directory = self.chats.get(str(chat_id))
+        if directory is None:
+            self.chats.delete(str(chat_id))
+        else:
+            directory.reset()
+        self.notify_changed(chat_id)
+
+    def invalidate(self, chat_id):
+        self.chats.delete(str(chat_id))
+        self.notify_changed(chat_id)
+
+    @staticmethod
+    def notify_changed(chat_id):
+        # Другие процессы бота выбросят свою копию чата
+        invalidation_bus.publish('user_directory', str(chat_id))
+
+    def drop(self, chat_id):
+        # Сообщение от другого процесса, дальше не публикуем
+        if chat_id is None:
+            self.chats.clear()
+        else:
+            self.chats.delete(chat_id)
+
+    @staticmethod
+    def load(chat_id):
+        # Счёт текущего сезона чата
+        rows = session.query(User.id, User.telegram_user_id, User.username, User.is_manager, UserScore.score) \
+            .outerjoin(Chat, Chat.chat_id == User.chat_id) \
+            .outerjoin(UserScore, and_(UserScore.user_id == User.id, UserScore.epoch == func.coalesce(Chat.epoch, 1))) \
+            .filter(User.chat_id == chat_id)
+        return [UserRecord(*row) for row in rows]
+
+
+user_directory = UserDirectory(maxsize=int(env_variables.get('USER_DIRECTORY_MAX_CHATS') or 1000),
+                               idle_ttl=float(env_variables.get('USER_DIRECTORY_IDLE_TTL') or timedelta(hours=1).total_seconds()))
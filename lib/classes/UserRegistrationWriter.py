@@ -0,0 +1,150 @@
+import threading
+from sqlalchemy import insert
+from app.models import User
+from config.db import session, unit_of_work
+from lib.classes.CacheBackend import Flight, MISSING
+from lib.errors import log_error
+from lib.helpers import env_variables
+from lib.classes.UserDirectory import user_directory, UserRecord
+from lib.classes.Leaderboard import leaderboards
+
+# После стольких неудачных попыток записи пользователь выбрасывается из буфера
+MAX_FLUSH_ATTEMPTS = 5
+
+
+class UserRegistrationWriter:
+    """
+    Буфер автоматической регистрации пользователей.
+    Новые пользователи копятся в памяти и записываются одним многострочным INSERT IGNORE (INSERT OR IGNORE в sqlite)
+    раз в flush_interval секунд или как только набралось batch_size строк.
+    До записи они уже видны в справочнике пользователей чата, но ещё без id.
+    Если запись не удалась, строки возвращаются в буфер и пишутся при следующем сбросе.
+    Сбросы идут по одному: вызвавший flush ждёт сброс, который уже идёт, чтобы взятые им пользователи получили id
+    """
+
+    def __init__(self, flush_interval, batch_size):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}
+        self.attempts = {}  # ключ буфера -> кол-во неудачных попыток записи
+        self.lock = threading.Lock()
+        # Идущий сейчас сброс. Flight ждут и потоки, и greenlet'ы асинхронного режима,
+        # threading.Lock заблокировал бы event loop, пока сброс в другом greenlet ждёт БД
+        self.flushing = None
+        self.wake = threading.Event()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, name="registration-writer", daemon=True).start()
+
+    def add(self, telegram_user_id, chat_id, username, score=0):
+        key = (str(chat_id), str(telegram_user_id))
+        with self.lock:
+            self.pending.setdefault(key, {
+                'telegram_user_id': str(telegram_user_id),
+                'chat_id': str(chat_id),
+                'username': username,
+            })
+            size = len(self.pending)
+        user_directory.add(chat_id, UserRecord(None, telegram_user_id, username, False, score))
+
+        if not self.running:
+            # Фоновый поток не запущен (скрипты, бенчмарки) - пишем сразу
+            self.flush()
+        elif size >= self.batch_size:
+            self.wake.set()
+
+    def flush(self):
+        while True:
+            with self.lock:
+                flight = self.flushing
+                if flight is None:
+                    rows = list(self.pending.values())
+                    self.pending.clear()
+                    if not rows:
+                        return
+                    self.flushing = flight = Flight()
+                    break
+            if flight.wait() is MISSING:
+                # Сброс идёт в другом потоке, greenlet может подождать его, только заблокировав свой поток
+                flight.event.wait()
+
+        try:
+            self.write(rows)
+        finally:
+            with self.lock:
+                self.flushing = None
+            flight.finish()
+
+    def write(self, rows):
+        try:
+            # Дубликаты по unique_user_chat просто пропускаются
+            session.execute(insert(User).values(rows).prefix_with('IGNORE', dialect='mysql')
+                            .prefix_with('OR IGNORE', dialect='sqlite'))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            log_error(f"registration writer {str(e)}")
+            self.requeue(rows)
+            return
+
+        with self.lock:
+            for row in rows:
+                self.attempts.pop((row['chat_id'], row['telegram_user_id']), None)
+
+        chats = {}
+        for row in rows:
+            chats.setdefault(row['chat_id'], []).append(row['telegram_user_id'])
+
+        for chat_id, telegram_user_ids in chats.items():
+            # Записанным пользователям проставляем id в справочнике
+            try:
+                for row in session.query(User.id, User.telegram_user_id, User.username, User.is_manager) \
+                        .filter(User.chat_id == chat_id, User.telegram_user_id.in_(telegram_user_ids)):
+                    user_directory.add(chat_id, UserRecord(*row, score=0))
+                user_directory.notify_changed(chat_id)
+            except Exception as e:
+                session.rollback()
+                log_error(f"registration writer {str(e)}")
+                user_directory.invalidate(chat_id)
+
+            # Новые пользователи появятся в рейтинге при следующей загрузке чата
+            leaderboards.invalidate(chat_id)
+
+    def requeue(self, rows):
+        """
+        Возвращает в буфер строки, которые не удалось записать
+
+        :param rows:
+        :return:
+        """
+        dropped_chats = set()
+        with self.lock:
+            for row in rows:
+                key = (row['chat_id'], row['telegram_user_id'])
+                attempts = self.attempts.get(key, 0) + 1
+                if attempts >= MAX_FLUSH_ATTEMPTS:
+                    self.attempts.pop(key, None)
+                    dropped_chats.add(row['chat_id'])
+                    continue
+                self.attempts[key] = attempts
+                # Более новая строка того же пользователя важнее
+                self.pending.setdefault(key, row)
+
+        for chat_id in dropped_chats:
+            log_error(f"registration writer dropped users of chat {chat_id}")
+            # Без id пользователь считался бы известным, а голоса за него терялись бы.
+            # Выбрасываем чат из справочника: со следующим сообщением пользователь зарегистрируется заново
+            user_directory.invalidate(chat_id)
+
+    def run(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            with unit_of_work():
+                self.flush()
+
+
+registration_writer = UserRegistrationWriter(float(env_variables.get('REGISTRATION_FLUSH_INTERVAL') or 0.3),
+                                             int(env_variables.get('REGISTRATION_BATCH_SIZE') or 200))
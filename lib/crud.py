@@ -1,16 +1,22 @@
-from app.models import User, Chat, Message
-from config.db import session
+from app.models import User, Chat, Message, UserScore
+from config.db import session, db_backend
 import datetime
 from lib.errors import log_error
 from lib.helpers import format_date, get_case
-from lib.classes.AutoRefreshTTLCache import user_cache
+from lib.cache import chat_exist_cache, user_id_cache, chat_setting_cache, can_manage_cache
+from lib.classes.UserDirectory import user_directory
+from lib.classes.UserRegistrationWriter import registration_writer
+from lib.classes.Leaderboard import leaderboards
+from lib.classes.ChatAdminCache import chat_admins
 from app.bot_phrases import get_clear_chat_message, get_no_user_found_message, get_user_or_chat_no_found_message, get_no_messages_found_message
-from sqlalchemy import func, case
+from sqlalchemy import func, case, insert, or_, and_, select, update
+from sqlalchemy.dialects import mysql, sqlite
 
 
 def add_user(telegram_user_id, chat_id, username, score=0):
     """
-    Добавляем пользователя в базу данных
+    Добавляем пользователя в базу данных.
+    Запись идёт пачками в фоне, но пользователь сразу виден в индексе участников чата
 
     :param telegram_user_id:
     :param chat_id:
@@ -18,31 +24,89 @@ def add_user(telegram_user_id, chat_id, username, score=0):
     :param score:
     :return:
     """
+    registration_writer.add(telegram_user_id, chat_id, username, score)
+
+
+def apply_vote(chat_id, points, message_text, from_username, usernames=(), telegram_user_ids=()):
+    """
+    Применяет одно изменение баллов сразу к нескольким пользователям чата одной транзакцией:
+    пользователи находятся в справочнике чата, дальше одна многострочная запись счёта текущего сезона
+    и одна многострочная запись в историю
+
+    :param chat_id: в каком чате
+    :param points: кол-во очков
+    :param message_text: сообщение
+    :param from_username: от кого
+    :param usernames: кому, по username
+    :param telegram_user_ids: кому, по telegram_user_id
+    :return: Список username пользователей, которым изменили баллы
+    """
     try:
-        user = User(telegram_user_id=telegram_user_id, chat_id=chat_id, username=username, score=score)
-        session.add(user)
+        directory = user_directory.get(chat_id)
+        records = directory.resolve(usernames, telegram_user_ids)
+
+        # Кто-то из упомянутых мог только что зарегистрироваться и ещё ждать записи в буфере
+        if any(record.id is None for record in records):
+            registration_writer.flush()
+            records = [record for record in directory.resolve(usernames, telegram_user_ids) if record.id is not None]
+        if not records:
+            return []
+
+        user_ids = [record.id for record in records]
+        epoch = get_chat_epoch_subquery(chat_id)
+        session.execute(upsert_user_scores([
+            {'user_id': user_id, 'epoch': epoch, 'chat_id': str(chat_id), 'score': points,
+             'added': max(points, 0), 'subtracted': min(points, 0)}
+            for user_id in user_ids
+        ]))
+        result = session.execute(insert(Message).values([
+            {'user_id': user_id, 'points': points, 'message': message_text, 'from_username': from_username,
+             'epoch': epoch}
+            for user_id in user_ids
+        ]))
         session.commit()
+
+        directory.apply(records, points)
+        leaderboards.apply(chat_id, [(record.id, record.username) for record in records], points, result.lastrowid)
+        return [record.username for record in records]
     except Exception as e:
         session.rollback()
         log_error(e)
+        return []
 
 
-def update_user_score(chat_id, username, score=1):
+def get_chat_epoch_subquery(chat_id):
     """
-    Обновляем счёт пользователя
+    Номер текущего сезона чата как подзапрос: сезон читается в той же инструкции, что и запись.
+    У чатов без записи в chats сезон первый
 
     :param chat_id:
-    :param username:
-    :param score:
     :return:
     """
-    try:
-        user = session.query(User).filter_by(username=username, chat_id=chat_id).first()
-        user.score = user.score + score
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        log_error(e)
+    return func.coalesce(select(Chat.epoch).where(Chat.chat_id == str(chat_id)).scalar_subquery(), 1)
+
+
+def upsert_user_scores(rows):
+    """
+    Многострочная запись в user_scores, которая прибавляет баллы к уже существующим строкам сезона
+
+    :param rows: Словари с user_id, epoch, chat_id, score, added, subtracted
+    :return: Инструкция для session.execute
+    """
+    table = UserScore.__table__
+    if db_backend == 'sqlite':
+        statement = sqlite.insert(table).values(rows)
+        new = statement.excluded
+        return statement.on_conflict_do_update(index_elements=[table.c.user_id, table.c.epoch], set_={
+            'score': table.c.score + new.score,
+            'added': table.c.added + new.added,
+            'subtracted': table.c.subtracted + new.subtracted,
+        })
+
+    statement = mysql.insert(table).values(rows)
+    new = statement.inserted
+    return statement.on_duplicate_key_update(score=table.c.score + new.score, added=table.c.added + new.added,
+                                             subtracted=table.c.subtracted + new.subtracted)
 
 
 def add_chat(chat_id, chat_name):
@@ -57,6 +121,8 @@ def add_chat(chat_id, chat_name):
         chat = Chat(chat_id=chat_id, chat_name=chat_name)
         session.add(chat)
         session.commit()
+        # Отрицательная запись из check_chat_exist больше не верна
+        chat_exist_cache.set(str(chat_id), True)
     except Exception as e:
         session.rollback()
         log_error(e)
@@ -70,20 +136,8 @@ def check_user_exist(chat_id, username):
     :param username:
     :return:
     """
-    cache_key = f"user_exist_{chat_id}_{username}"
-    result = user_cache.get(cache_key)
-
-    if result is not None:
-        return result
-
     try:
-        user = session.query(User).filter_by(username=username, chat_id=chat_id).first()
-        result = bool(user)
-
-        if result:
-            user_cache.set(cache_key, result)
-
-        return result
+        return user_directory.get(chat_id).find_by_username(username) is not None
     except Exception as e:
         session.rollback()
         log_error(e)
@@ -97,20 +151,9 @@ def check_user_exist_by_telegram_user_id(chat_id, telegram_user_id):
     :param telegram_user_id:
     :return:
     """
-    cache_key = f"user_exist_{chat_id}_{telegram_user_id}"
-    result = user_cache.get(cache_key)
-
-    if result is not None:
-        return result
-
     try:
-        user = session.query(User).filter_by(telegram_user_id=telegram_user_id, chat_id=chat_id).first()
-        result = bool(user)
-
-        if result:
-            user_cache.set(cache_key, result)
-
-        return result
+        # Справочник загружает чат одним запросом, дальше проверка идёт только в памяти
+        return user_directory.get(chat_id).find_by_telegram_user_id(telegram_user_id) is not None
     except Exception as e:
         session.rollback()
         log_error(e)
@@ -118,109 +161,225 @@ def check_user_exist_by_telegram_user_id(chat_id, telegram_user_id):
 
 def clear_chat_score(chat_id):
     """
-    Очищаем счёт пользователей
+    Очищаем счёт пользователей: чат переходит в новый сезон, строки пользователей не меняются,
+    счёт прошлых сезонов остаётся в user_scores
 
     :param chat_id:
     :return:
     """
-    chat = session.query(Chat).filter_by(chat_id=chat_id).first()
-    if chat:
-        session.query(User).filter_by(chat_id=chat_id).update({User.score: 0})
-        chat.last_reset = datetime.datetime.now()
-        session.commit()
+    result = session.execute(update(Chat).where(Chat.chat_id == str(chat_id)).values(
+        epoch=Chat.epoch + 1, last_reset=datetime.datetime.now()))
+    session.commit()
+    if result.rowcount:
+        user_directory.reset(chat_id)
+        leaderboards.reset(chat_id)
         return get_clear_chat_message()
 
 
-def get_chat_ranking(chat_id):
+def get_chat_ranking(chat_id, season=None):
     """
     Возвращает сообщеие с топом пользователей по Е-баллам
 
     :param chat_id:
+    :param season: Номер прошлого сезона, по умолчанию текущий
     :return:
     """
-    # Получить последний reset для данного чата
-    chat = session.query(Chat).filter_by(chat_id=chat_id).first()
-    last_reset = chat.last_reset if chat else None
+    current_season = session.query(Chat.epoch).filter_by(chat_id=chat_id).scalar() or 1
+    if season and season != current_season:
+        return get_season_ranking(chat_id, season) if season < current_season else get_no_user_found_message()
 
-    # Найти топ-10 пользователей по текущему количеству баллов
-    users = session.query(User).filter_by(chat_id=chat_id).order_by(User.score.desc()).limit(10).all()
+    # Найти топ-10 пользователей по текущему количеству баллов.
+    # Рейтинг чата хранится в памяти, добавленные и отнятые за сезон баллы - в нём же
+    users = leaderboards.get(chat_id).top(10)
 
     if not users:
         return get_no_user_found_message()
 
-    # Извлекаем ID пользователей из топ-10
-    user_ids = [user.id for user in users]
-
-    # Запрос на получение всех сообщений для этих пользователей после последней очистки, одним запросом
-    messages_after_reset = session.query(
-        Message.user_id,
-        func.sum(case((Message.points > 0, Message.points), else_=0)).label("total_added"),
-        func.sum(case((Message.points < 0, Message.points), else_=0)).label("total_subtracted")
-    ).filter(
-        Message.user_id.in_(user_ids),
-        Message.created_at > last_reset if last_reset else True
-    ).group_by(Message.user_id).all()
-
-    # Преобразование сообщений в словарь для быстрого доступа
-    messages_summary = {msg.user_id: (msg.total_added or 0, msg.total_subtracted or 0) for msg in messages_after_reset}
-
     # Формирование рейтинга
     ranking = []
     for idx, user in enumerate(users, start=1):
-        # Извлекаем добавленные и отнятые баллы для текущего пользователя
-        total_added, total_subtracted = messages_summary.get(user.id, (0, 0))
-
         score_word = get_case(user.score)
 
         ranking.append(
             f"{idx}. @{user.username} - текущее количество: {user.score} {score_word}; "
-            f"\nДобавлено: +{total_added}; \nОтнято: {total_subtracted};"
+            f"\nДобавлено: +{user.added}; \nОтнято: {user.subtracted};"
+        )
+
+    return "\n".join(ranking)
+
+
+def get_season_ranking(chat_id, season):
+    """
+    Топ пользователей прошлого сезона, читается из user_scores по индексу (chat_id, epoch, score)
+
+    :param chat_id:
+    :param season:
+    :return:
+    """
+    users = session.query(User.username, UserScore.score, UserScore.added, UserScore.subtracted) \
+        .join(User, User.id == UserScore.user_id) \
+        .filter(UserScore.chat_id == str(chat_id), UserScore.epoch == season) \
+        .order_by(UserScore.score.desc(), UserScore.user_id).limit(10).all()
+
+    if not users:
+        return get_no_user_found_message()
+
+    ranking = [f"Сезон {season}:"]
+    for idx, (username, score, added, subtracted) in enumerate(users, start=1):
+        ranking.append(
+            f"{idx}. @{username} - {score} {get_case(score)}; "
+            f"\nДобавлено: +{added}; \nОтнято: {subtracted};"
         )
 
     return "\n".join(ranking)
 
 
-def get_user_messages(chat_id, user_id):
+def rebuild_user_scores(connection, chat_id=None, epoch=None):
+    """
+    Пересчитывает счёт пользователей по сезонам по таблице messages
+
+    :param connection: Соединение SQLAlchemy (миграция или engine.begin())
+    :param chat_id: Пересчитать только этот чат, по умолчанию все
+    :param epoch: Пересчитать только этот сезон, по умолчанию все
+    :return: Кол-во записанных строк
     """
-    Возвращает все сообщения начислений пользователя в чате, которые были отправлены после последней очистки (last_reset).
+    users = User.__table__
+    messages = Message.__table__
+    user_scores = UserScore.__table__
+
+    totals_query = select(
+        messages.c.user_id,
+        messages.c.epoch,
+        users.c.chat_id,
+        func.sum(messages.c.points),
+        func.sum(case((messages.c.points > 0, messages.c.points), else_=0)),
+        func.sum(case((messages.c.points < 0, messages.c.points), else_=0)),
+    ).join(users, users.c.id == messages.c.user_id).group_by(messages.c.user_id, messages.c.epoch, users.c.chat_id)
+    delete_query = user_scores.delete()
+
+    if chat_id is not None:
+        totals_query = totals_query.where(users.c.chat_id == str(chat_id))
+        delete_query = delete_query.where(user_scores.c.chat_id == str(chat_id))
+    if epoch is not None:
+        totals_query = totals_query.where(messages.c.epoch == epoch)
+        delete_query = delete_query.where(user_scores.c.epoch == epoch)
+
+    connection.execute(delete_query)
+    return connection.execute(insert(user_scores).from_select(
+        ['user_id', 'epoch', 'chat_id', 'score', 'added', 'subtracted'], totals_query)).rowcount
+
+
+def get_user_rank_line(chat_id, user_id):
+    """
+    Строка с местом пользователя в рейтинге чата, например "Место в рейтинге: #37 из 2 400"
 
     :param chat_id:
     :param user_id:
     :return:
     """
+    board = leaderboards.get(chat_id)
+    rank = board.rank(user_id)
+    if rank is None:
+        return ""
+    total = f"{board.size():,}".replace(',', ' ')
+    return f"\nМесто в рейтинге: #{rank} из {total}"
+
+
+# Кол-во записей истории на одной странице /get_user_score
+HISTORY_PAGE_SIZE = 10
+
+# Максимальная длина комментария в истории, чтобы страница влезала в одно сообщение
+HISTORY_COMMENT_MAX_LENGTH = 200
+
+# Формат даты в курсоре пагинации (callback_data кнопок ограничена 64 байтами).
+# С микросекундами: created_at проставляет приложение, и записи одной секунды не должны теряться на границе страниц
+HISTORY_CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+# Курсоры кнопок, отправленных до появления микросекунд
+HISTORY_CURSOR_SECONDS_FORMAT = '%Y%m%d%H%M%S'
+
+
+def encode_history_cursor(message):
+    return f"{message.created_at.strftime(HISTORY_CURSOR_FORMAT)}_{message.id}"
+
+
+def decode_history_cursor(cursor):
+    created_at, message_id = cursor.split('_')
+    cursor_format = HISTORY_CURSOR_SECONDS_FORMAT if len(created_at) == 14 else HISTORY_CURSOR_FORMAT
+    return datetime.datetime.strptime(created_at, cursor_format), int(message_id)
+
+
+def get_user_messages_page(chat_id, user_id, cursor=None, newer=False):
+    """
+    Возвращает одну страницу истории начислений пользователя за текущий сезон.
+    Страницы листаются по ключу (created_at, id), поэтому в память попадает только одна страница
+
+    :param chat_id:
+    :param user_id:
+    :param cursor: Курсор записи, от которой листаем, None - первая (самая новая) страница
+    :param newer: Листать к более новым записям, по умолчанию к более старым
+    :return: Кортеж (текст, курсор для более новых записей или None, курсор для более старых записей или None)
+    """
     # Получаем чат и пользователя
     chat = session.query(Chat).filter_by(chat_id=chat_id).first()
-    user = session.query(User).filter_by(id=user_id).first()
+    user = session.query(User).filter_by(chat_id=chat_id, id=user_id).first()
 
-    if chat and user:
-        # Фильтруем сообщения по дате, позже чем last_reset
-        if chat.last_reset:
-            messages = session.query(Message).filter(
-                Message.user_id == user.id,
-                Message.created_at > chat.last_reset
-            ).order_by(Message.created_at.desc()).all()
-        else:
-            messages = session.query(Message).filter_by(user_id=user.id).order_by(Message.created_at.desc()).all()
-
-        if messages:
-            message_list = [
-                f"{format_date(message.created_at)}: {'+{0}'.format(message.points) if message.points > 0 else f'{message.points}'} - {message.message if message.message and message.message.strip() else '**без комментария**'} от {message.from_username}"
-                for message in messages]
-            result = f"Общий счет пользователя: {user.score}"
-            if message_list:
-                result += f"\n\nИстория начисления:\n" + "\n".join(
-                    message_list)
-            return result
+    if not (chat and user):
+        return get_user_or_chat_no_found_message(), None, None
+
+    # Только сообщения текущего сезона, индекс (user_id, epoch, created_at)
+    query = session.query(Message).filter(Message.user_id == user.id, Message.epoch == chat.epoch)
+
+    if cursor:
+        created_at, message_id = decode_history_cursor(cursor)
+        if newer:
+            query = query.filter(or_(Message.created_at > created_at,
+                                     and_(Message.created_at == created_at, Message.id > message_id)))
         else:
-            return get_no_messages_found_message()
+            query = query.filter(or_(Message.created_at < created_at,
+                                     and_(Message.created_at == created_at, Message.id < message_id)))
+
+    if newer:
+        query = query.order_by(Message.created_at.asc(), Message.id.asc())
     else:
-        return get_user_or_chat_no_found_message()
+        query = query.order_by(Message.created_at.desc(), Message.id.desc())
+
+    # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+    messages = query.limit(HISTORY_PAGE_SIZE + 1).all()
+    has_more = len(messages) > HISTORY_PAGE_SIZE
+    messages = messages[:HISTORY_PAGE_SIZE]
+
+    if newer:
+        messages.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = cursor is not None, has_more
+
+    if not messages:
+        return get_no_messages_found_message(), None, None
+
+    message_list = []
+    for message in messages:
+        comment = message.message.strip() if message.message and message.message.strip() else '**без комментария**'
+        if len(comment) > HISTORY_COMMENT_MAX_LENGTH:
+            comment = comment[:HISTORY_COMMENT_MAX_LENGTH] + '…'
+        points = '+{0}'.format(message.points) if message.points > 0 else f'{message.points}'
+        message_list.append(f"{format_date(message.created_at)}: {points} - {comment} от {message.from_username}")
+
+    entry = leaderboards.get(chat_id).get(user.id)
+    result = f"Общий счет пользователя: {entry.score if entry else 0}"
+    result += get_user_rank_line(chat_id, user.id)
+    result += f"\n\nИстория начисления:\n" + "\n".join(message_list)
+
+    newer_cursor = encode_history_cursor(messages[0]) if has_newer else None
+    older_cursor = encode_history_cursor(messages[-1]) if has_older else None
+    return result, newer_cursor, older_cursor
 
 
 def get_all_user_messages(chat_id, user_id):
     """
     Возвращает все сообщения начислений пользователя в чате.
-    Сообщения до last_reset выводятся отдельно и маркируются.
+    Сообщения прошлых сезонов выводятся отдельно и маркируются.
 
     :param chat_id:
     :param user_id:
@@ -231,23 +390,17 @@ def get_all_user_messages(chat_id, user_id):
     user = session.query(User).filter_by(chat_id=chat_id, id=user_id).first()
 
     if chat and user:
-        # Сообщения после last_reset
-        if chat.last_reset:
-            recent_messages = session.query(Message).filter(
-                Message.user_id == user.id,
-                Message.created_at > chat.last_reset
-            ).order_by(Message.created_at.desc()).all()
-
-            # Сообщения до last_reset
-            older_messages = session.query(Message).filter(
-                Message.user_id == user.id,
-                Message.created_at <= chat.last_reset
-            ).order_by(Message.created_at.desc()).all()
-        else:
-            # Если очистка не производилась, просто берем все сообщения
-            recent_messages = session.query(Message).filter_by(user_id=user.id).order_by(
-                Message.created_at.desc()).all()
-            older_messages = []
+        # Сообщения текущего сезона
+        recent_messages = session.query(Message).filter(
+            Message.user_id == user.id,
+            Message.epoch == chat.epoch
+        ).order_by(Message.created_at.desc()).all()
+
+        # Сообщения прошлых сезонов
+        older_messages = session.query(Message).filter(
+            Message.user_id == user.id,
+            Message.epoch < chat.epoch
+        ).order_by(Message.created_at.desc()).all()
 
         # Формируем вывод сообщений
         recent_message_list = [
@@ -257,7 +410,8 @@ def get_all_user_messages(chat_id, user_id):
             f"{format_date(message.created_at)}: {'+{0}'.format(message.points) if message.points > 0 else f'{message.points}'} - {message.message if message.message and message.message.strip() else '**без комментария**'} от {message.from_username}"
             for message in older_messages]
 
-        result = f"Общий счет пользователя: {user.score}\n"
+        entry = leaderboards.get(chat_id).get(user.id)
+        result = f"Общий счет пользователя: {entry.score if entry else 0}\n"
         if recent_message_list:
             result += "История начисления:\n" + "\n".join(recent_message_list)
 
@@ -270,32 +424,19 @@ def get_all_user_messages(chat_id, user_id):
         return get_user_or_chat_no_found_message()
 
 
-def add_message(chat_id, telegram_user_id, message_text, from_username, points):
+def iter_chat_history(chat_id, batch_size=1000):
     """
-    Добавляет сообщение для пользователя в чате.
+    Вся история начислений чата в порядке записи. Строки читаются с сервера пачками по batch_size
+    (серверный курсор), поэтому память не зависит от размера истории
 
-    :param chat_id: в каком чате
-    :param telegram_user_id: кому
-    :param message_text: сообщение
-    :param from_username: от кого
-    :param points: кол-во очков
-    :return:
+    :param chat_id:
+    :param batch_size:
+    :return: Генератор строк (id, created_at, epoch, username, telegram_user_id, points, from_username, message)
     """
-    # Получаем пользователя в указанном чате
-    user = session.query(User).filter_by(chat_id=chat_id, telegram_user_id=telegram_user_id).first()
-
-    # Если пользователь существует, добавляем сообщение
-    if user:
-        new_message = Message(
-            user_id=user.id,
-            points=points,
-            message=message_text,
-            from_username=from_username
-        )
-
-        # Добавляем новое сообщение в сессию и сохраняем
-        session.add(new_message)
-        session.commit()
+    query = select(Message.id, Message.created_at, Message.epoch, User.username, User.telegram_user_id,
+                   Message.points, Message.from_username, Message.message) \
+        .join(User, User.id == Message.user_id).where(User.chat_id == str(chat_id)).order_by(Message.id)
+    yield from session.execute(query.execution_options(yield_per=batch_size))
 
 
 def get_user_id_from_username(chat_id, username):
@@ -306,42 +447,13 @@ def get_user_id_from_username(chat_id, username):
     :param username:
     :return:
     """
-    cache_key = f"user_id_{chat_id}_{username}"
-    user_id = user_cache.get(cache_key)
-
-    if user_id:
-        return user_id
-
-    user = session.query(User).filter_by(chat_id=chat_id, username=username).first()
-    user_id = user.id if user else None
-
-    if user_id:
-        user_cache.set(cache_key, user_id)
-
-    return user_id
-
-
-def get_telegram_user_id_from_username(chat_id, username):
-    """
-    Возвращает telegram_user_id по имени пользователя в указанном чате.
-
-    :param chat_id:
-    :param username:
-    :return:
-    """
-    cache_key = f"telegram_user_id_{chat_id}_{username}"
-    telegram_user_id = user_cache.get(cache_key)
-
-    if telegram_user_id:
-        return telegram_user_id
+    record = user_directory.get(chat_id).find_by_username(username)
+    if record is not None and record.id is None:
+        # Пользователь ещё ждёт записи в буфере регистрации
+        registration_writer.flush()
+        record = user_directory.get(chat_id).find_by_username(username)
 
-    user = session.query(User).filter_by(chat_id=chat_id, username=username).first()
-    telegram_user_id = user.telegram_user_id if user else None
-
-    if telegram_user_id:
-        user_cache.set(cache_key, telegram_user_id)
-
-    return telegram_user_id
+    return record.id if record else None
 
 
 def check_chat_exist(chat_id):
@@ -351,19 +463,11 @@ def check_chat_exist(chat_id):
     :param chat_id:
     :return:
     """
-    cache_key = f"is_chat_exist_{chat_id}"
-    chat_exists = user_cache.get(cache_key)
-
-    if chat_exists:
-        return True
+    def load():
+        # None - чата нет, такой ответ кэшируется ненадолго
+        return True if session.query(Chat.chat_id).filter_by(chat_id=chat_id).first() else None
 
-    chat = session.query(Chat).filter_by(chat_id=chat_id).first()
-    is_exists = True if chat else False
-
-    if is_exists:
-        user_cache.set(cache_key, True)
-
-    return is_exists
+    return chat_exist_cache.get_or_load(str(chat_id), load) is True
 
 
 def can_manage_chat(chat_id, telegram_user_id, bot):
@@ -375,22 +479,14 @@ def can_manage_chat(chat_id, telegram_user_id, bot):
     :param bot: Чтобы понять является ли админом
     :return:
     """
-    cache_key = f"can_manage_chat_{chat_id}_{telegram_user_id}"
-    cache_value = user_cache.get(cache_key)
-
-    if cache_value:
-        return True
-
-    user = session.query(User).filter_by(chat_id=chat_id, telegram_user_id=telegram_user_id).first()
-    if user.is_manager:
-        user_cache.set(cache_key, True)
-        return True
-    admins = bot.get_chat_administrators(chat_id)
-    for admin in admins:
-        if admin.user.id == telegram_user_id:
-            user_cache.set(cache_key, True)
+    def load():
+        user = user_directory.get(chat_id).find_by_telegram_user_id(telegram_user_id)
+        if (user and user.is_manager) or chat_admins.is_admin(bot, chat_id, telegram_user_id):
             return True
-    return False
+        # Отказ запоминаем ненадолго: каждая попытка обычного участника изменить больше 1 балла не идёт в Telegram
+        return None
+
+    return can_manage_cache.get_or_load((str(chat_id), str(telegram_user_id)), load) is True
 
 
 def can_add_multiple_points(chat_id, telegram_user_id, bot):
@@ -402,16 +498,11 @@ def can_add_multiple_points(chat_id, telegram_user_id, bot):
     :param bot:
     :return:
     """
-    cache_key = f"chat_send_few_carma_{chat_id}"
-    setting = user_cache.get(cache_key)
-
+    # Кэшируем и 'managers', иначе каждая такая попытка шла бы в БД
+    setting = chat_setting_cache.get_or_load(
+        str(chat_id), lambda: session.query(Chat.send_few_carma).filter_by(chat_id=chat_id).scalar())
     if setting == 'all':
         return True
-
-    chat = session.query(Chat).filter_by(chat_id=chat_id).first()
-    if chat.send_few_carma == 'all':
-        user_cache.set(cache_key, 'all')
-        return True
     return can_manage_chat(chat_id, telegram_user_id, bot)
 
 
@@ -422,10 +513,5 @@ def get_telegram_user_id_by_user_id(user_id):
     :param user_id: id пользоваталея в базе данных
     :return: telegram_user_id
     """
-    cache_key = f"get_telegram_user_id_by_user_id_{user_id}"
-    telegram_user_id = user_cache.get(cache_key)
-    if telegram_user_id:
-        return telegram_user_id
-    user = session.query(User).filter_by(id=user_id).first()
-    user_cache.set(cache_key, user.telegram_user_id)
-    return user.telegram_user_id
\ No newline at end of file
+    return user_id_cache.get_or_load(
+        str(user_id), lambda: session.query(User.telegram_user_id).filter_by(id=user_id).scalar())
@@ -1,7 +1,25 @@
 import re
-from lib.crud import can_add_multiple_points, check_user_exist, update_user_score, add_message, get_telegram_user_id_from_username
+from lib.crud import can_add_multiple_points, apply_vote, check_user_exist_by_telegram_user_id
 from app.bot_phrases import get_user_not_found_message, get_user_odd_point_message, get_user_add_point_message, \
     get_self_mentions_message
+from lib.classes.OutboundScheduler import outbound_scheduler, PRIORITY_FLAVOR, PRIORITY_INTERACTIVE
+from lib.classes.ReplyBuilder import ReplyBuilder
+from lib.classes.ParsedVote import ParsedVote
+
+# Упоминание по username
+MENTION_PATTERN = re.compile(r"@(\w+)")
+
+# Первое упоминание, сразу после которого (через пробелы) идёт изменение баллов
+VOTE_PATTERN = re.compile(r"@(\w+)\s*(\+\+|--|—|[+-]\d+)")
+
+# Изменение баллов сразу после упоминания (через пробелы)
+VOTE_TOKEN_PATTERN = re.compile(r"\s*(\+\+|--|—|[+-]\d+)")
+
+# Изменение баллов в начале ответа на сообщение и текст после него
+REPLY_VOTE_PATTERN = re.compile(r"([+-]?\d+|--|\+\+|—)\s*(.*)")
+
+# Типы entities, которые указывают на пользователя
+MENTION_ENTITY_TYPES = ('mention', 'text_mention')
 
 
 def extract_points_and_text(message_text):
@@ -76,6 +94,129 @@ def get_remaining_message(message_text, number, mentions):
     return None
 
 
+def parse_vote_token(token):
+    if token == '++':
+        return 1
+    if token in ('--', '—'):
+        return -1
+    return int(token)
+
+
+def get_mention_spans(text, entities):
+    """
+    Упоминания пользователей в тексте
+
+    :param text: Текст сообщения
+    :param entities: message.entities или None, тогда упоминания ищутся по тексту
+    :return: Список (начало, конец, username или None, пользователь из text_mention или None)
+    """
+    if entities is None:
+        return [(match.start(), match.end(), match.group(1), None) for match in MENTION_PATTERN.finditer(text)]
+
+    mention_entities = sorted((entity for entity in entities if entity.type in MENTION_ENTITY_TYPES),
+                              key=lambda entity: entity.offset)
+    if not mention_entities:
+        return []
+
+    # Смещения entities считаются в UTF-16, символы вне BMP (эмодзи) занимают по две позиции
+    if len(text.encode('utf-16-le')) == 2 * len(text):
+        positions = None
+    else:
+        positions = []
+        for index, char in enumerate(text):
+            positions.append(index)
+            if ord(char) > 0xFFFF:
+                positions.append(index)
+        positions.append(len(text))
+
+    spans = []
+    for entity in mention_entities:
+        start, end = entity.offset, entity.offset + entity.length
+        if positions is not None:
+            start, end = positions[start], positions[end]
+        if entity.type == 'mention':
+            spans.append((start, end, text[start + 1:end], None))
+        else:
+            spans.append((start, end, None, entity.user))
+    return spans
+
+
+def parse_vote(text, entities=None):
+    """
+    Разбирает сообщение с упоминаниями за один проход: кому, на сколько и с каким комментарием.
+    Баллы - первое ++/--/—/+N/-N сразу после упоминания, комментарий - текст после них до конца строки
+    без упоминаний. По entities находятся и пользователи без username (text_mention)
+
+    :param text: Текст сообщения
+    :param entities: message.entities, если есть
+    :return: ParsedVote или None, если это не изменение баллов
+    """
+    # Быстрый отказ: без упоминания или без знака баллов это обычное сообщение
+    if not text or ('@' not in text and not entities):
+        return None
+    if '+' not in text and '-' not in text and '—' not in text:
+        return None
+
+    if entities:
+        spans = get_mention_spans(text, entities)
+        match = None
+        for span in spans:
+            match = VOTE_TOKEN_PATTERN.match(text, span[1])
+            if match:
+                break
+        token = match.group(1) if match else None
+    else:
+        spans = None
+        match = VOTE_PATTERN.search(text)
+        token = match.group(2) if match else None
+
+    delta = parse_vote_token(token) if token else None
+    if not delta:
+        return None
+
+    comment = None
+    token_end = match.end()
+    if text[token_end:token_end + 1] == ' ':
+        line_end = text.find('\n', token_end)
+        if line_end == -1:
+            line_end = len(text)
+        if spans is None:
+            comment = MENTION_PATTERN.sub('', text[token_end + 1:line_end])
+        else:
+            # Вырезаем упоминания из строки комментария по их позициям
+            parts = []
+            position = token_end + 1
+            for start, end, username, user in spans:
+                if start >= position and end <= line_end:
+                    parts.append(text[position:start])
+                    position = end
+            parts.append(text[position:line_end])
+            comment = ''.join(parts)
+        comment = comment.strip() or None
+
+    if spans is None:
+        return ParsedVote(MENTION_PATTERN.findall(text), [], delta, comment)
+    usernames = [username for start, end, username, user in spans if username]
+    text_mentions = [(user.id, user.first_name) for start, end, username, user in spans if user is not None]
+    return ParsedVote(usernames, text_mentions, delta, comment)
+
+
+def parse_reply_vote(text):
+    """
+    Разбирает ответ на сообщение: баллы в начале и комментарий после них
+
+    :param text: Текст сообщения
+    :return: ParsedVote без получателей или None, если это не изменение баллов
+    """
+    match = REPLY_VOTE_PATTERN.match(text.strip()) if text else None
+    if not match:
+        return None
+    delta = parse_vote_token(match.group(1))
+    if not delta:
+        return None
+    return ParsedVote([], [], delta, match.group(2).strip() or None)
+
+
 def can_modify_points(chat_id, telegram_user_id, number, bot):
     """
     Проверяет, может ли пользователь изменять количество баллов больше чем на 1.
@@ -89,65 +230,74 @@ def can_modify_points(chat_id, telegram_user_id, number, bot):
     return not (number > 1 or number < -1) or can_add_multiple_points(chat_id, telegram_user_id, bot)
 
 
-def sort_users(chat_id, mentions, from_username):
+def sort_users(mentions, from_username):
     """
-    Разделяет упомянутых пользователей на существующих и несуществующих,
-    а также фиксирует попытки пользователя изменить свои собственные баллы.
+    Убирает повторные упоминания и фиксирует попытку пользователя изменить свои собственные баллы.
 
-    :param chat_id: ID чата
     :param mentions: Список упоминаний
     :param from_username: Имя отправителя сообщения
-    :return: Кортеж из трех списков (существующие пользователи, несуществующие пользователи, самозванец)
+    :return: Кортеж (упомянутые пользователи, самозванец)
     """
-    not_founded_user = set()
-    founded_user = set()
-    self_mention = None  # Пользователи, которые пытались изменить свои баллы
+    mentioned_users = []
+    self_mention = None  # Пользователь, который пытался изменить свои баллы
 
     for mention in mentions:
         if mention == from_username:  # Если пользователь пытается изменить свои баллы
             self_mention = mention
-        elif check_user_exist(chat_id, mention):
-            founded_user.add(mention)
-        else:
-            not_founded_user.add(mention)
+        elif mention not in mentioned_users:
+            mentioned_users.append(mention)
 
-    return list(founded_user), list(not_founded_user), self_mention
+    return mentioned_users, self_mention
 
 
-def handle_points_update(chat_id, founded_user, number, remaining_message, telegram_user_id, from_username):
+def handle_points_update(chat_id, mentioned_users, number, remaining_message, from_username, text_mentions=()):
     """
-    Обновляет баллы для существующих пользователей.
+    Обновляет баллы упомянутых пользователей одной транзакцией.
 
     :param chat_id: ID чата
-    :param founded_user: Список существующих пользователей
+    :param mentioned_users: Список упомянутых пользователей
     :param number: Количество баллов
     :param remaining_message: Оставшаяся часть сообщения
-    :param telegram_user_id: ID отправителя
     :param from_username: Имя отправителя
+    :param text_mentions: Упомянутые без username, список (telegram_user_id, имя)
+    :return: Кортеж из двух списков (существующие пользователи, несуществующие пользователи)
     """
-    for mention in founded_user:
-        update_user_score(chat_id, mention, number)
-        mention_telegram_user_id = get_telegram_user_id_from_username(chat_id, mention)
-        add_message(chat_id, mention_telegram_user_id, remaining_message, from_username, number)
+    known_text_mentions = [(telegram_user_id, name) for telegram_user_id, name in text_mentions
+                           if check_user_exist_by_telegram_user_id(chat_id, telegram_user_id)]
+    founded_user = apply_vote(chat_id, number, remaining_message, from_username, usernames=mentioned_users,
+                              telegram_user_ids=[telegram_user_id for telegram_user_id, name in known_text_mentions])
+
+    # Telegram не различает регистр в username, MySQL при сравнении тоже
+    founded_lower = {username.lower() for username in founded_user}
+    not_founded_user = [mention for mention in mentioned_users if mention.lower() not in founded_lower]
+    not_founded_user += [name for telegram_user_id, name in text_mentions
+                         if (telegram_user_id, name) not in known_text_mentions]
 
+    return founded_user, not_founded_user
 
-def send_response(bot, message, founded_user, not_founded_user, number):
+
+def send_response(bot, message, founded_user, not_founded_user, number, self_mention=None):
     """
-    Отправляет сообщения с результатами изменения баллов.
+    Отправляет одним сообщением все результаты изменения баллов.
 
     :param bot: Экземпляр бота
     :param message: Сообщение, на которое нужно ответить
     :param founded_user: Список пользователей, для которых были изменены баллы
     :param not_founded_user: Список несуществующих пользователей
     :param number: Количество баллов
+    :param self_mention: Пользователь, который пытался изменить свои баллы
     """
+    replies = ReplyBuilder()
+    if self_mention:
+        replies.add(get_self_mentions_message(self_mention))
     if not_founded_user:
-        bot.reply_to(message, get_user_not_found_message(not_founded_user))
+        replies.add(get_user_not_found_message(not_founded_user))
     if founded_user:
         if number > 0:
-            bot.reply_to(message, get_user_add_point_message(founded_user, number))
+            replies.add(get_user_add_point_message(founded_user, number))
         elif number < 0:
-            bot.reply_to(message, get_user_odd_point_message(founded_user, number))
+            replies.add(get_user_odd_point_message(founded_user, number))
+    replies.send(bot, message)
 
 
 def send_self_mention_message(bot, message, self_mention):
@@ -160,7 +310,7 @@ def send_self_mention_message(bot, message, self_mention):
     """
     if self_mention:
         message_text = get_self_mentions_message(self_mention)
-        bot.reply_to(message, message_text)
+        send_reply(bot, message, message_text)
 
 
 def send_long_message(bot, message, text, max_length=4096 - 10):
@@ -174,9 +324,33 @@ def send_long_message(bot, message, text, max_length=4096 - 10):
     """
     # Разбиваем текст на части, если длина превышает max_length
     if len(text) <= max_length:
-        bot.reply_to(message, text)
+        send_reply(bot, message, text, PRIORITY_INTERACTIVE)
     else:
         # Разбиваем текст на части
         for i in range(0, len(text), max_length):
             part = text[i:i + max_length]
-            bot.reply_to(message, part)
\ No newline at end of file
+            send_reply(bot, message, part, PRIORITY_INTERACTIVE)
+
+
+def send_reply(bot, message, text, priority=PRIORITY_FLAVOR, **kwargs):
+    """
+    Ставит ответ на сообщение в очередь исходящих сообщений, обработчик не ждёт отправки.
+
+    :param bot: Экземпляр бота
+    :param message: Сообщение, на которое нужно ответить
+    :param text: Текст ответа
+    :param priority: PRIORITY_INTERACTIVE для ответов на команды, PRIORITY_FLAVOR для реакций на баллы
+    """
+    outbound_scheduler.submit(message.chat.id, priority, bot.reply_to, message, text, **kwargs)
+
+
+def send_chat_message(bot, chat_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """
+    Ставит сообщение в чат в очередь исходящих сообщений.
+
+    :param bot: Экземпляр бота
+    :param chat_id: ID чата
+    :param text: Текст сообщения
+    :param priority: PRIORITY_INTERACTIVE или PRIORITY_FLAVOR
+    """
+    outbound_scheduler.submit(chat_id, priority, bot.send_message, chat_id, text, **kwargs)
@@ -73,3 +73,12 @@ def get_case(count):
         return "Е-балла"
     else:
         return "Е-баллов"
+
+
+def is_async_runtime():
+    """
+    Запущен ли бот в асинхронном режиме (BOT_RUNTIME=async) на AsyncTeleBot
+
+    :return:
+    """
+    return env_variables.get('BOT_RUNTIME') == 'async'
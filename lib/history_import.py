@@ -0,0 +1,256 @@
+import datetime
+import json
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import insert, func, select
+from app.models import User, Chat, Message
+from lib.crud import rebuild_user_scores
+from lib.functions import parse_vote, parse_reply_vote, sort_users
+
+# Размер куска файла, который читается за раз
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Начало массива сообщений в экспорте Telegram Desktop
+MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+
+
+def iter_export_messages(path):
+    """
+    Сообщения из result.json экспорта Telegram Desktop по одному.
+    Файл читается кусками, в памяти только текущий кусок и одно сообщение
+
+    :param path: Путь к result.json
+    :return: Генератор словарей сообщений
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as file:
+        buffer = ''
+        while True:
+            chunk = file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            buffer += chunk
+            match = MESSAGES_KEY.search(buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            # Оставляем хвост, вдруг ключ разрезан между кусками
+            buffer = buffer[-32:]
+
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer):
+                if buffer[position] == ']':
+                    return
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    end = None
+                if end is not None:
+                    position = end
+                    yield item
+                    continue
+
+            # Сообщение не поместилось в буфер целиком, дочитываем файл
+            chunk = file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("Файл экспорта обрывается посреди массива messages")
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def get_plain_text(text):
+    """
+    Текст сообщения экспорта: строка или список из строк и кусков с разметкой
+
+    :param text:
+    :return:
+    """
+    if isinstance(text, str):
+        return text
+    return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+
+
+def parse_telegram_user_id(from_id):
+    # В экспорте автор записан как "user123456", у каналов - "channel123"
+    if from_id and from_id.startswith('user') and from_id[4:].isdigit():
+        return int(from_id[4:])
+    return None
+
+
+def parse_votes(messages):
+    """
+    Находит изменения баллов в пачке сообщений теми же парсерами, что и обработчик сообщений.
+    Выполняется в отдельном процессе
+
+    :param messages: Список сообщений экспорта
+    :return: Список кортежей (created_at, автор, упомянутые username, id сообщения-ответа, баллы, комментарий)
+    """
+    votes = []
+    for message in messages:
+        if message.get('type') != 'message':
+            continue
+        telegram_user_id = parse_telegram_user_id(message.get('from_id'))
+        text = get_plain_text(message.get('text', ''))
+        if telegram_user_id is None or not text:
+            continue
+        created_at = datetime.datetime.fromisoformat(message['date'])
+
+        vote = parse_vote(text)
+        if vote:
+            mentioned_users, _ = sort_users(vote.usernames, None)
+            votes.append((created_at, telegram_user_id, mentioned_users, None, vote.delta, vote.comment))
+        elif '@' not in text and message.get('reply_to_message_id'):
+            vote = parse_reply_vote(text)
+            if vote:
+                votes.append((created_at, telegram_user_id, [], message['reply_to_message_id'], vote.delta,
+                              vote.comment))
+    return votes
+
+
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class HistoryImport:
+    """
+    Импорт истории начислений чата из экспорта Telegram Desktop.
+    Разбор сообщений идёт в пуле процессов, запись - многострочными INSERT пачками.
+    В экспорте нет username, поэтому баллы получают только уже известные боту пользователи чата.
+    Хранится только дата последней очистки, поэтому сообщения до неё импортируются, лишь если очистка была одна
+    """
+
+    def __init__(self, connection, chat_id, workers, batch_size):
+        self.connection = connection
+        self.chat_id = str(chat_id)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.authors = {}  # id сообщения -> telegram_user_id автора, для голосов ответом
+        self.rows = []
+        self.stats = {'messages': 0, 'votes': 0, 'imported': 0, 'skipped_unknown': 0, 'skipped_rules': 0,
+                      'skipped_live': 0, 'skipped_old_seasons': 0}
+
+    def load_chat(self):
+        chat = self.connection.execute(select(Chat.epoch, Chat.last_reset, Chat.send_few_carma)
+                                       .where(Chat.chat_id == self.chat_id)).first()
+        if chat is None:
+            raise ValueError(f"Чат {self.chat_id} не найден, сначала добавьте в него бота")
+        self.epoch, self.last_reset, self.send_few_carma = chat
+
+        users = self.connection.execute(select(User.id, User.telegram_user_id, User.username, User.is_manager)
+                                        .where(User.chat_id == self.chat_id)).all()
+        self.users_by_username = {}
+        self.users_by_telegram_user_id = {}
+        for user_id, telegram_user_id, username, is_manager in users:
+            self.users_by_telegram_user_id[int(telegram_user_id)] = (user_id, username, is_manager)
+            self.users_by_username.setdefault(username.lower(), (user_id, username, is_manager))
+
+        # Всё, что бот уже записал сам, из экспорта не берём: повторный импорт ничего не задвоит
+        self.live_since = self.connection.execute(
+            select(func.min(Message.created_at)).join(User, User.id == Message.user_id)
+            .where(User.chat_id == self.chat_id)).scalar()
+
+    def run(self, path):
+        self.load_chat()
+        self.rows = []
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for batch in self.iter_message_batches(path):
+                pending.append(executor.submit(parse_votes, batch))
+                # Держим в работе не больше двух пачек на процесс, чтобы не читать весь файл в память
+                if len(pending) >= self.workers * 2:
+                    self.add_votes(pending.popleft().result())
+            while pending:
+                self.add_votes(pending.popleft().result())
+        if self.rows:
+            self.write(self.rows)
+
+        # Счёт пересчитывается по истории, вместе с импортированными сообщениями
+        rebuild_user_scores(self.connection, self.chat_id)
+        return self.stats
+
+    def add_votes(self, votes):
+        # Пачки обрабатываются в порядке файла, так что сообщения пишутся по порядку
+        for vote in votes:
+            self.rows.extend(self.resolve(*vote))
+            if len(self.rows) >= self.batch_size:
+                self.write(self.rows)
+                self.rows = []
+
+    def iter_message_batches(self, path):
+        for batch in iter_batches(iter_export_messages(path), self.batch_size):
+            # Авторов запоминаем до разбора, ответы ссылаются на более ранние сообщения
+            for message in batch:
+                telegram_user_id = parse_telegram_user_id(message.get('from_id'))
+                if telegram_user_id is not None:
+                    self.authors[message['id']] = telegram_user_id
+            self.stats['messages'] += len(batch)
+            yield batch
+
+    def resolve(self, created_at, telegram_user_id, usernames, reply_to_message_id, points, comment):
+        """
+        Превращает голос в строки messages
+
+        :return: Список словарей для INSERT
+        """
+        self.stats['votes'] += 1
+        if self.live_since and created_at >= self.live_since:
+            self.stats['skipped_live'] += 1
+            return []
+
+        if self.last_reset and created_at <= self.last_reset:
+            # Сезоны нумеруются с 1, каждая очистка начинает следующий
+            if self.epoch > 2:
+                # Очисток было несколько, а границы сезонов до последней не сохранились
+                self.stats['skipped_old_seasons'] += 1
+                return []
+            epoch = self.epoch - 1
+        else:
+            epoch = self.epoch
+
+        voter = self.users_by_telegram_user_id.get(telegram_user_id)
+        if (points > 1 or points < -1) and self.send_few_carma != 'all' and not (voter and voter[2]):
+            # Менять больше чем на 1 балл могли только менеджеры
+            self.stats['skipped_rules'] += 1
+            return []
+
+        if reply_to_message_id:
+            target_telegram_user_id = self.authors.get(reply_to_message_id)
+            targets = [self.users_by_telegram_user_id.get(target_telegram_user_id)]
+        else:
+            targets = [self.users_by_username.get(username.lower()) for username in usernames]
+
+        rows = []
+        seen = set()
+        for target in targets:
+            if target is None:
+                self.stats['skipped_unknown'] += 1
+                continue
+            user_id = target[0]
+            if user_id in seen or (voter and voter[0] == user_id):
+                continue
+            seen.add(user_id)
+            rows.append({
+                'user_id': user_id,
+                'points': points,
+                'message': comment,
+                'from_username': voter[1] if voter else str(telegram_user_id),
+                'created_at': created_at,
+                'epoch': epoch,
+            })
+        return rows
+
+    def write(self, rows):
+        self.connection.execute(insert(Message), rows)
+        self.connection.commit()
+        self.stats['imported'] += len(rows)
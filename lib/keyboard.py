@@ -2,10 +2,13 @@ from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from app.models import User, Chat
 from config.db import session
 from app.bot_phrases import get_user_no_chats_message, get_user_odd_point_message, get_user_add_point_message
-from lib.crud import update_user_score, add_message, get_telegram_user_id_by_user_id
+from lib.crud import apply_vote, get_telegram_user_id_by_user_id, get_user_messages_page
 from lib.state import awaiting_count_of_point
-from lib.functions import send_self_mention_message
-from lib.classes.AutoRefreshTTLCache import user_cache
+from lib.functions import send_self_mention_message, send_reply
+from lib.classes.OutboundScheduler import PRIORITY_INTERACTIVE
+from lib.cache import chat_setting_cache, can_manage_cache
+from lib.classes.UserDirectory import user_directory
+from lib.classes.ChatAdminCache import chat_admins
 import re
 
 
@@ -54,6 +57,10 @@ def bot_keyboard_buttons_handler(call, bot):
         case action if action.startswith('fap_'):
             wait_user_points_changing(call, bot)
 
+        # Листание истории начислений /get_user_score
+        case action if action.startswith('uh_'):
+            user_history_page(call, bot)
+
     bot.answer_callback_query(call.id)  # Сообщаем Telegram, что запрос был обработан
 
 
@@ -113,6 +120,29 @@ def get_group_settings_keyboard_markup(chat_id):
     return markup
 
 
+def get_history_keyboard_markup(user_id, newer_cursor, older_cursor):
+    """
+    Кнопки листания истории начислений
+
+    :param user_id:
+    :param newer_cursor: Курсор для более новых записей
+    :param older_cursor: Курсор для более старых записей
+    :return: InlineKeyboardMarkup или None, если листать некуда
+    """
+    buttons = []
+    if newer_cursor:
+        buttons.append(InlineKeyboardButton("← Новее", callback_data=f"uh_p_{user_id}_{newer_cursor}"))
+    if older_cursor:
+        buttons.append(InlineKeyboardButton("Старее →", callback_data=f"uh_n_{user_id}_{older_cursor}"))
+
+    if not buttons:
+        return None
+
+    markup = InlineKeyboardMarkup()
+    markup.add(*buttons)
+    return markup
+
+
 def get_chats_keyboard_markup(telegram_user_id, func_name, bot, should_be_manager=False):
     """
     Все чаты пользователя
@@ -126,16 +156,11 @@ def get_chats_keyboard_markup(telegram_user_id, func_name, bot, should_be_manage
     if should_be_manager:
         all_user_chats = session.query(Chat, User).join(User, User.chat_id == Chat.chat_id).filter(
             User.telegram_user_id == telegram_user_id).all()
-        user_chats = []
-        for chat, user in all_user_chats:
-            if user.is_manager:
-                user_chats.append(chat)
-                continue
-            admins = bot.get_chat_administrators(chat.chat_id)
-            for admin in admins:
-                if admin.user.id == telegram_user_id:
-                    user_chats.append(chat)
-                    continue
+        # Администраторов всех чатов, где пользователь не менеджер, запрашиваем одновременно
+        chats_admins = chat_admins.get_many(bot, [chat.chat_id for chat, user in all_user_chats if not user.is_manager])
+        user_chats = [chat for chat, user in all_user_chats
+                      if user.is_manager or any(admin.telegram_user_id == telegram_user_id
+                                                for admin in chats_admins[str(chat.chat_id)])]
 
     else:
         user_chats = session.query(Chat).join(User, User.chat_id == Chat.chat_id).filter(
@@ -208,14 +233,13 @@ def set_chat_settings(call, bot):
     """
     chat_id = call.data[5:]
     chat = session.query(Chat).filter_by(chat_id=chat_id).first()
-    cache_key = f"chat_send_few_carma_{chat_id}"
 
     if call.data.startswith('cs_a_'):
         chat.send_few_carma = 'all'
-        user_cache.set(cache_key, 'all')
+        chat_setting_cache.set(chat_id, 'all')
     elif call.data.startswith('cs_m_'):
         chat.send_few_carma = 'managers'
-        user_cache.set(cache_key, 'managers')
+        chat_setting_cache.set(chat_id, 'managers')
     session.commit()
     bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
                           text='Настройки чата изменены!')
@@ -295,6 +319,9 @@ def managers_action(call, bot):
         user.is_manager = False
         message_text = f"{user.username} больше не является менеджером"
     session.commit()
+    user_directory.set_manager(user.chat_id, user.telegram_user_id, user.is_manager)
+    # Закэширован и отказ, и разрешение - при любом изменении проверяем заново
+    can_manage_cache.delete((str(user.chat_id), str(user.telegram_user_id)))
     bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
                           text=message_text)
 
@@ -369,10 +396,10 @@ def maybe_change_points(message, user_id, bot):
 
         if number_str == '0':
             awaiting_count_of_point[message.chat.id] = user_id
-            bot.reply_to(message, 'Что-то пошло не так, введите количество Е-баллов в формате: +(-)n message\n'
-                                  'Где n - количество баллов которые надо добавить или отнять\n'
-                                  'message - сообщение которое хотите добавить при изменении баллов (необязательно)\n\n'
-                                  'Попробуйте ещё раз!')
+            send_reply(bot, message, 'Что-то пошло не так, введите количество Е-баллов в формате: +(-)n message\n'
+                                     'Где n - количество баллов которые надо добавить или отнять\n'
+                                     'message - сообщение которое хотите добавить при изменении баллов (необязательно)\n\n'
+                                     'Попробуйте ещё раз!', PRIORITY_INTERACTIVE)
             return
 
         if number_str == '++':
@@ -383,19 +410,18 @@ def maybe_change_points(message, user_id, bot):
             number = int(number_str)
 
         if number >= 0:
-            bot.reply_to(message, get_user_add_point_message(user.username, number))
+            send_reply(bot, message, get_user_add_point_message(user.username, number), PRIORITY_INTERACTIVE)
         else:
-            bot.reply_to(message, get_user_odd_point_message(user.username, number))
+            send_reply(bot, message, get_user_odd_point_message(user.username, number), PRIORITY_INTERACTIVE)
 
         # Обновление баллов и добавление записи в историю
-        update_user_score(user.chat_id, user.username, number)
-        add_message(user.chat_id, user.telegram_user_id, text, message.from_user.username, number)
+        apply_vote(user.chat_id, number, text, message.from_user.username, telegram_user_ids=[user.telegram_user_id])
     else:
         awaiting_count_of_point[message.chat.id] = user_id
-        bot.reply_to(message, 'Что-то пошло не так, введите количество Е-баллов в формате: +(-)n message\n'
-                              'Где n - количество баллов которые надо добавить или отнять\n'
-                              'message - сообщение которое хотите добавить при изменении баллов (необязательно)\n\n'
-                              'Попробуйте ещё раз!')
+        send_reply(bot, message, 'Что-то пошло не так, введите количество Е-баллов в формате: +(-)n message\n'
+                                 'Где n - количество баллов которые надо добавить или отнять\n'
+                                 'message - сообщение которое хотите добавить при изменении баллов (необязательно)\n\n'
+                                 'Попробуйте ещё раз!', PRIORITY_INTERACTIVE)
 
 
 def select_chat_message(call, bot, prefix, should_be_manager):
@@ -435,13 +461,13 @@ def view_all_managers(call, bot):
                               text='В этом чате включен режим без менеджеров!')
     else:
         # Получаем администраторов чата
-        admins = bot.get_chat_administrators(chat_id)
-        admin_list = [f"{admin.user.username or 'нет ника'}" for admin in admins]
-        admin_ids = [admin.user.id for admin in admins]
+        admins = chat_admins.get(bot, chat_id)
+        admin_list = [f"{admin.username or 'нет ника'}" for admin in admins]
+        admin_ids = [admin.telegram_user_id for admin in admins]
 
         # Получаем менеджеров и исключаем администраторов
         managers = session.query(User).filter_by(chat_id=chat_id, is_manager=True).all()
-        managers = [manager for manager in managers if manager.id not in admin_ids]
+        managers = [manager for manager in managers if int(manager.telegram_user_id) not in admin_ids]
         manager_list = [f"{manager.username}" for manager in managers]
 
         # Формируем текст сообщения
@@ -454,3 +480,19 @@ def view_all_managers(call, bot):
         # Обновляем сообщение в чате
         bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id,
                               text=message_text)
+
+
+def user_history_page(call, bot):
+    """
+    Показывает соседнюю страницу истории начислений в том же сообщении
+
+    :param call:
+    :param bot:
+    :return:
+    """
+    # uh_{p|n}_{user_id}_{cursor}
+    _, direction, user_id, cursor = call.data.split('_', 3)
+    result, newer_cursor, older_cursor = get_user_messages_page(str(call.message.chat.id), int(user_id), cursor,
+                                                                newer=direction == 'p')
+    bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=result,
+                          reply_markup=get_history_keyboard_markup(user_id, newer_cursor, older_cursor))
@@ -0,0 +1,181 @@
+import functools
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telebot import apihelper
+from lib.classes.MetricsRegistry import metrics
+from lib.errors import log_error
+from lib.helpers import env_variables
+
+# Пустой METRICS_PORT - метрики не собираются и сервер не запускается
+metrics_host = env_variables.get('METRICS_HOST') or '127.0.0.1'
+metrics_port = env_variables.get('METRICS_PORT')
+
+# Запросы к БД намного короче обработчиков, корзины мельче
+SQL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# Модули бота: по ним в стеке ищется функция, из которой пришёл запрос к БД
+APP_MODULE_PREFIXES = ('lib.', 'app.')
+
+# Обработчик, внутри которого выполняется код. Своё значение у каждого потока и greenlet
+current_handler = ContextVar('current_handler', default='none')
+
+handler_duration = metrics.histogram('botushka_handler_duration_seconds', "Время работы обработчика апдейта",
+                                     ('handler',))
+handler_errors = metrics.counter('botushka_handler_errors_total', "Обработчики, завершившиеся исключением",
+                                 ('handler',))
+sql_duration = metrics.histogram('botushka_sql_duration_seconds',
+                                 "Время SQL запросов по обработчику и функции, из которой они выполнены",
+                                 ('handler', 'caller'), SQL_BUCKETS)
+api_calls = metrics.counter('botushka_api_calls_total', "Вызовы Bot API по методу и HTTP статусу",
+                            ('method', 'status'))
+api_duration = metrics.histogram('botushka_api_duration_seconds', "Время вызовов Bot API", ('method',))
+
+
+def observe_handler(handler):
+    """
+    Оборачивает обработчик: время работы и ошибки попадают в метрики,
+    а запросы к БД внутри него помечаются его именем
+
+    :param handler:
+    :return:
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    def observed(*args, **kwargs):
+        token = current_handler.set(name)
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started, name)
+            current_handler.reset(token)
+
+    return observed
+
+
+def get_sql_caller():
+    """
+    Ближайшая к запросу функция бота (crud, справочники, клавиатуры) по стеку вызовов
+
+    :return: Например crud.apply_vote или UserDirectory.load
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith(APP_MODULE_PREFIXES) and module != __name__:
+            # Генераторы списков и вложенные функции относим к функции, в которой они объявлены
+            qualname = frame.f_code.co_qualname.split('.<locals>', 1)[0]
+            return qualname if '.' in qualname else f"{module.rsplit('.', 1)[-1]}.{qualname}"
+        frame = frame.f_back
+    return 'unknown'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    sql_duration.observe(time.perf_counter() - context.metrics_started, current_handler.get(), get_sql_caller())
+
+
+def install_sql_hooks():
+    # Слушаем класс Engine: так попадают и синхронный, и асинхронный движки
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def get_api_method_name(name):
+    # send_message -> sendMessage, как в Bot API и в синхронном режиме
+    return re.sub(r'_(\w)', lambda match: match.group(1).upper(), name)
+
+
+def observe_api_call(method_name, started, status):
+    api_calls.inc(method_name, status)
+    api_duration.observe(time.perf_counter() - started, method_name)
+
+
+def send_api_request(method, url, **kwargs):
+    """
+    Отправка запроса к Bot API вместо стандартной в telebot.apihelper, с замером
+
+    :return: requests.Response
+    """
+    method_name = url.rsplit('/', 1)[-1]
+    started = time.perf_counter()
+    try:
+        result = apihelper._get_req_session().request(method, url, **kwargs)
+    except Exception:
+        observe_api_call(method_name, started, 'error')
+        raise
+    observe_api_call(method_name, started, str(result.status_code))
+    return result
+
+
+def make_metrics_handler():
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def register_queue_gauges(dispatcher=None):
+    from lib.classes.OutboundScheduler import outbound_scheduler
+    from lib.classes.UserRegistrationWriter import registration_writer
+    from lib.classes.ChatExporter import chat_exporter
+
+    if dispatcher is not None:
+        metrics.gauge('botushka_dispatcher_queue_depth', "Апдейты в очередях воркеров диспетчера",
+                      lambda: sum(shard_queue.qsize() for shard_queue in dispatcher.queues))
+    metrics.gauge('botushka_outbound_queue_depth', "Исходящие сообщения в очереди отправки", outbound_scheduler.size)
+    metrics.gauge('botushka_registration_queue_depth', "Пользователи в буфере регистрации",
+                  lambda: len(registration_writer.pending))
+    metrics.gauge('botushka_export_queue_depth', "Выгрузки истории в очереди", chat_exporter.jobs.qsize)
+
+
+def is_metrics_enabled():
+    return bool(metrics_port)
+
+
+def start_metrics_server(dispatcher=None):
+    """
+    Включает замеры запросов к БД и Bot API и запускает HTTP сервер /metrics в фоновом потоке
+
+    :param dispatcher: ChatDispatcher, длина его очередей тоже попадает в метрики
+    :return:
+    """
+    if not is_metrics_enabled():
+        return
+    install_sql_hooks()
+    # Синхронный TeleBot отправляет запросы через apihelper, асинхронный считается в AsyncBotBridge
+    apihelper.CUSTOM_REQUEST_SENDER = send_api_request
+    register_queue_gauges(dispatcher)
+
+    try:
+        server = ThreadingHTTPServer((metrics_host, int(metrics_port)), make_metrics_handler())
+    except OSError as e:
+        log_error(f"metrics server {str(e)}")
+        return
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
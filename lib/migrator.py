@@ -0,0 +1,97 @@
+import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.schema import CreateIndex
+from config.db import engine
+from lib.errors import log_error
+
+metadata = MetaData()
+
+# Таблица с номерами уже применённых миграций
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(255), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def create_index_if_missing(connection, index):
+    """
+    Создаёт индекс, если его ещё нет. В MySQL индекс строится онлайн,
+    без блокировки записи в таблицу
+
+    :param connection:
+    :param index: sqlalchemy Index
+    :return:
+    """
+    existing = {item['name'] for item in inspect(connection).get_indexes(index.table.name)}
+    if index.name in existing:
+        return
+
+    statement = str(CreateIndex(index).compile(dialect=connection.dialect))
+    if connection.dialect.name == 'mysql':
+        statement += ' ALGORITHM=INPLACE LOCK=NONE'
+    connection.execute(text(statement))
+
+
+def drop_index_if_exists(connection, table_name, index_name):
+    """
+    Удаляет индекс, если он есть
+
+    :param connection:
+    :param table_name:
+    :param index_name:
+    :return:
+    """
+    existing = {item['name'] for item in inspect(connection).get_indexes(table_name)}
+    if index_name not in existing:
+        return
+
+    if connection.dialect.name == 'mysql':
+        connection.execute(text(f"DROP INDEX {index_name} ON {table_name} ALGORITHM=INPLACE LOCK=NONE"))
+    else:
+        connection.execute(text(f"DROP INDEX {index_name}"))
+
+
+def add_column_if_missing(connection, table_name, column_name, column_ddl):
+    """
+    Добавляет колонку, если её ещё нет
+
+    :param connection:
+    :param table_name:
+    :param column_name:
+    :param column_ddl: Описание колонки, например "INT NOT NULL DEFAULT 0"
+    :return:
+    """
+    existing = {item['name'] for item in inspect(connection).get_columns(table_name)}
+    if column_name not in existing:
+        connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_ddl}"))
+
+
+def run_migrations():
+    """
+    Применяет по порядку все миграции из app/migrations.py, которые ещё не применены.
+    Каждая миграция должна быть повторяемой: DDL в MySQL не откатывается транзакцией
+
+    :return: Список применённых номеров
+    """
+    from app.migrations import migrations
+
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        applied = set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+    done = []
+    for version, name, migration in migrations:
+        if version in applied:
+            continue
+        try:
+            with engine.begin() as connection:
+                migration(connection)
+                connection.execute(schema_migrations.insert().values(
+                    version=version, name=name, applied_at=datetime.datetime.now()))
+        except Exception as e:
+            log_error(f"migration {version} {name} {str(e)}")
+            raise
+        done.append(version)
+    return done
@@ -0,0 +1,31 @@
+import time
+from app.handlers import allowed_updates
+from lib.errors import log_error
+
+# Сколько секунд Telegram держит long polling запрос
+POLLING_TIMEOUT = 20
+
+
+def run_polling(bot, dispatcher):
+    """
+    Long polling, который передаёт апдейты в диспетчер вместо потоков telebot
+
+    :param bot:
+    :param dispatcher: ChatDispatcher
+    :return:
+    """
+    bot.remove_webhook()
+    offset = None
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, long_polling_timeout=POLLING_TIMEOUT,
+                                      allowed_updates=allowed_updates)
+        except Exception as e:
+            log_error(f"polling {str(e)}")
+            time.sleep(3)
+            continue
+
+        for update in updates:
+            # Если все очереди заняты, ждём - это естественное ограничение скорости чтения
+            dispatcher.dispatch(update)
+            offset = update.update_id + 1
@@ -0,0 +1,123 @@
+import hmac
+import ssl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot.types import Update
+from app.handlers import allowed_updates
+from lib.errors import log_error
+from lib.helpers import env_variables
+
+# Заголовок, в котором Telegram присылает secret_token, указанный при set_webhook
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Ограничение на размер тела запроса, апдейты Telegram намного меньше
+MAX_BODY_SIZE = 1024 * 1024
+
+webhook_url = env_variables.get('WEBHOOK_URL')
+webhook_host = env_variables.get('WEBHOOK_HOST') or '0.0.0.0'
+webhook_port = int(env_variables.get('WEBHOOK_PORT') or 8443)
+webhook_path = env_variables.get('WEBHOOK_PATH') or '/webhook'
+# Без секрета кто угодно мог бы присылать поддельные апдейты. Он общий для всех процессов бота:
+# set_webhook из последнего запущенного процесса не должен ломать проверку в остальных
+webhook_secret = env_variables.get('WEBHOOK_SECRET')
+webhook_ssl_cert = env_variables.get('WEBHOOK_SSL_CERT')
+webhook_ssl_key = env_variables.get('WEBHOOK_SSL_KEY')
+
+
+def is_webhook_mode():
+    """
+    Запущен ли бот в режиме вебхука (BOT_MODE=webhook), иначе используется polling
+
+    :return:
+    """
+    return env_variables.get('BOT_MODE') == 'webhook'
+
+
+def check_webhook_settings():
+    """
+    Останавливает запуск в режиме вебхука без WEBHOOK_SECRET
+
+    :return:
+    """
+    if not webhook_secret:
+        raise SystemExit("BOT_MODE=webhook: не задан WEBHOOK_SECRET, например: "
+                         "python -c \"import secrets; print(secrets.token_urlsafe(32))\"")
+
+
+def make_webhook_handler(dispatcher, secret, path):
+    """
+    Создаёт класс обработчика HTTP запросов от Telegram
+
+    :param dispatcher: ChatDispatcher, в очереди которого складываем апдейты
+    :param secret: Секретный токен вебхука
+    :param path: Путь, на который Telegram присылает апдейты
+    :return:
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_error(404)
+                return
+
+            # Проверяем, что запрос пришёл именно от Telegram
+            received_secret = self.headers.get(SECRET_HEADER) or ''
+            if not hmac.compare_digest(received_secret, secret):
+                self.send_error(403)
+                return
+
+            length = int(self.headers.get('Content-Length') or 0)
+            if length <= 0 or length > MAX_BODY_SIZE:
+                self.send_error(400)
+                return
+
+            try:
+                update = Update.de_json(self.rfile.read(length).decode('utf-8'))
+            except Exception as e:
+                log_error(f"webhook bad update {str(e)}")
+                self.send_error(400)
+                return
+
+            if not dispatcher.dispatch(update, block=False):
+                # Очередь переполнена, Telegram повторит доставку позже
+                log_error(f"webhook queue is full, update {update.update_id} rejected")
+                self.send_error(503)
+                return
+
+            # Отвечаем сразу, обработка идёт в воркерах
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            # Не засоряем вывод логом каждого запроса
+            pass
+
+    return WebhookHandler
+
+
+def run_webhook(bot, dispatcher):
+    """
+    Регистрирует вебхук в Telegram и запускает HTTP сервер
+
+    :param bot:
+    :param dispatcher: ChatDispatcher с запущенными воркерами
+    :return:
+    """
+    check_webhook_settings()
+    bot.remove_webhook()
+    if webhook_ssl_cert:
+        # Самоподписанный сертификат нужно передать в Telegram
+        with open(webhook_ssl_cert, 'rb') as certificate:
+            bot.set_webhook(url=webhook_url, certificate=certificate, secret_token=webhook_secret,
+                            allowed_updates=allowed_updates)
+    else:
+        bot.set_webhook(url=webhook_url, secret_token=webhook_secret, allowed_updates=allowed_updates)
+
+    server = ThreadingHTTPServer((webhook_host, webhook_port),
+                                 make_webhook_handler(dispatcher, webhook_secret, webhook_path))
+    if webhook_ssl_cert and webhook_ssl_key:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(webhook_ssl_cert, webhook_ssl_key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    server.serve_forever()
@@ -0,0 +1,246 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+
+def command_migrate(args):
+    from lib.migrator import run_migrations
+
+    applied = run_migrations()
+    print(f"Применено миграций: {len(applied)} {applied if applied else ''}")
+
+
+def command_rebuild_scores(args):
+    from config.db import engine
+    from lib.crud import rebuild_user_scores
+
+    with engine.begin() as connection:
+        rows_count = rebuild_user_scores(connection, args.chat_id, args.season)
+    print(f"Пересчитано строк счёта: {rows_count}")
+
+
+def command_import_history(args):
+    from config.db import engine
+    from lib.history_import import HistoryImport
+    from lib.cache import shared_cache_client
+    from lib.classes.UserDirectory import user_directory
+    from lib.classes.Leaderboard import leaderboards
+
+    with engine.connect() as connection:
+        stats = HistoryImport(connection, args.chat_id, args.workers, args.batch_size).run(args.path)
+        connection.commit()
+    print(f"Сообщений в экспорте: {stats['messages']}, изменений баллов: {stats['votes']}, "
+          f"записано: {stats['imported']}")
+    print(f"Пропущено: неизвестные пользователи {stats['skipped_unknown']}, "
+          f"больше 1 балла без прав {stats['skipped_rules']}, уже записаны ботом {stats['skipped_live']}")
+    if stats['skipped_old_seasons']:
+        print(f"Пропущено сообщений до последней очистки: {stats['skipped_old_seasons']} - "
+              f"очисток было несколько, сезон таких сообщений не определить")
+
+    # Запущенные процессы бота выбрасывают чат из памяти и загружают его заново
+    user_directory.invalidate(args.chat_id)
+    leaderboards.invalidate(args.chat_id)
+    if shared_cache_client is None:
+        print("Рейтинги в памяти запущенного бота обновятся после перезапуска или LEADERBOARD_IDLE_TTL, "
+              "сразу - с CACHE_BACKEND=shared")
+
+
+def utf16_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def generate_parser_corpus(size, seed):
+    """
+    Сообщения, похожие на переписку чата: большая часть без изменения баллов, есть эмодзи
+    и другие символы вне BMP, часть упоминаний - пользователи без username (text_mention)
+
+    :param size:
+    :param seed:
+    :return: Список (текст, entities, текст для прежнего разбора). entities - кортежи
+        (тип, offset, length, id пользователя, имя) со смещениями в UTF-16, как их присылает Telegram.
+        В тексте для прежнего разбора text_mention заменён на @id<id пользователя>
+    """
+    rnd = random.Random(seed)
+    words = ['привет', 'спасибо', 'за', 'помощь', 'ок', 'завтра', 'в', '10', 'релиз', 'почта', 'e-mail', 'C++', 'нет',
+             '🙂', '🚀', 'огонь🔥', '𝔫𝔬𝔱𝔢', '👍🏻']
+    names = ['Аня 🌸', 'Ivan', '𝓜𝓪𝔁', 'Петя', '🐈 Кот']
+    tokens = ['++', '--', '—', '+1', '-1', '+3', '-2', '+0', '+15']
+
+    def mention():
+        if rnd.random() < 0.3:
+            user_id = rnd.randint(1000, 1050)
+            return rnd.choice(names), 'text_mention', user_id
+        return f"@user{rnd.randint(1, 50)}", 'mention', None
+
+    corpus = []
+    for _ in range(size):
+        kind = rnd.random()
+        pieces = [(' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 12))), None, None)]
+        if kind < 0.15:
+            mentions = [mention() for _ in range(rnd.randint(1, 3))]
+            prefix = [(rnd.choice(words) + ' ', None, None)] if rnd.random() < 0.3 else []
+            pieces = prefix + [piece for item in mentions for piece in (item, (' ', None, None))][:-1] \
+                + [(f" {rnd.choice(tokens)} ", None, None)] + pieces
+        elif kind < 0.25:
+            pieces += [(' ', None, None), mention()]
+
+        text, old_text, entities = '', '', []
+        for fragment, entity_type, user_id in pieces:
+            if entity_type is not None:
+                entities.append((entity_type, utf16_length(text), utf16_length(fragment), user_id, fragment))
+            old_text += f"@id{user_id}" if entity_type == 'text_mention' else fragment
+            text += fragment
+        corpus.append((text, entities, old_text))
+    return corpus
+
+
+def command_bench_parser(args):
+    from telebot.types import MessageEntity, User
+    from lib.functions import extract_mentions_and_number, get_remaining_message, parse_vote
+
+    def parse_old(text):
+        if '@' not in text:
+            return None
+        mentions, number = extract_mentions_and_number(text)
+        if not number:
+            return None
+        return mentions, number, get_remaining_message(text, number, mentions)
+
+    def parse_new(text):
+        vote = parse_vote(text)
+        return (vote.usernames, vote.delta, vote.comment) if vote else None
+
+    def parse_new_entities(item):
+        vote = parse_vote(item[0], item[1])
+        if not vote:
+            return None
+        # Пользователи без username - в том же виде, что в тексте для прежнего разбора
+        return vote.usernames + [f"id{user_id}" for user_id, first_name in vote.text_mentions], vote.delta, vote.comment
+
+    def parse_old_entities(item):
+        old = parse_old(item[2])
+        if not old:
+            return None
+        # Прежний разбор отдаёт упоминания по порядку в тексте, новый - сначала username, потом text_mention
+        usernames = [name for name in old[0] if not name.startswith('id')] + [name for name in old[0] if name.startswith('id')]
+        return usernames, old[1], old[2]
+
+    corpus = generate_parser_corpus(args.size, args.seed)
+    texts = [text for text, entities, old_text in corpus]
+    with_entities = [(text, [MessageEntity(entity_type, offset, length,
+                                           user=User(user_id, False, name) if user_id else None)
+                             for entity_type, offset, length, user_id, name in entities], old_text)
+                     for text, entities, old_text in corpus]
+
+    timings = {}
+    results = {}
+    for name, parse, items in (('old', parse_old, texts), ('parse_vote', parse_new, texts),
+                               ('old (text_mention как @id)', parse_old_entities, with_entities),
+                               ('parse_vote с entities', parse_new_entities, with_entities)):
+        started = time.perf_counter()
+        results[name] = [parse(item) for item in items]
+        timings[name] = time.perf_counter() - started
+        print(f"{name}: {timings[name] * 1000:.1f} мс, {args.size / timings[name]:.0f} сообщений/с")
+    print(f"Ускорение: {timings['old'] / timings['parse_vote']:.1f}x, с entities "
+          f"{timings['old (text_mention как @id)'] / timings['parse_vote с entities']:.1f}x")
+
+    # Получатели и баллы должны совпадать, комментарий теперь берётся после баллов, а не после любого числа
+    failed = False
+    for label, old_name, new_name in (('без entities', 'old', 'parse_vote'),
+                                      ('с entities', 'old (text_mention как @id)', 'parse_vote с entities')):
+        pairs = list(zip(corpus, results[old_name], results[new_name]))
+        mismatches = [item[0] for item, old, new in pairs if (old and old[:2]) != (new and new[:2])]
+        comments = sum(1 for item, old, new in pairs if old and new and old[2] != new[2])
+        print(f"Расхождений {label} в получателях и баллах: {len(mismatches)}, в комментарии: {comments}")
+        for text in mismatches[:10]:
+            print(f"  {text!r}")
+        failed = failed or bool(mismatches)
+    if failed:
+        raise SystemExit(1)
+
+
+def command_bench(args):
+    from lib.helpers import env_variables
+
+    db_path = None
+    if not args.use_configured_db:
+        # По умолчанию - чистая sqlite во временном файле, настройки БД должны поменяться до импорта config.db
+        db_path = os.path.join(tempfile.mkdtemp(prefix='botushka-bench-'), 'bench.db')
+        env_variables['DB_BACKEND'] = 'sqlite'
+        env_variables['DB_PATH'] = db_path
+
+    from lib.migrator import run_migrations
+    from lib.benchmark import SyntheticWorld, run_benchmark, format_report
+
+    run_migrations()
+    world = SyntheticWorld(args.chats, args.members, args.vote_ratio, args.multi_mention_ratio, args.reply_ratio,
+                           args.command_ratio, args.callback_ratio, args.seed)
+    print(format_report(*run_benchmark(world, args.updates)))
+    if db_path:
+        print(f"База: {db_path}")
+
+
+def command_cache_server(args):
+    from lib.cache import CACHE_NAMESPACES, cache_socket, get_namespace_settings
+    from lib.classes.SharedCache import CacheServer
+
+    socket_path = args.socket or cache_socket
+    print(f"Сервер кэша слушает {socket_path}")
+    CacheServer(socket_path, {namespace: get_namespace_settings(namespace) for namespace in CACHE_NAMESPACES}) \
+        .serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Служебные команды бота")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('migrate', help="Применить миграции БД").set_defaults(func=command_migrate)
+
+    rebuild = subparsers.add_parser('rebuild_scores', help="Пересчитать счёт пользователей по сезонам по истории")
+    rebuild.add_argument('--chat-id', help="Только этот чат")
+    rebuild.add_argument('--season', type=int, help="Только этот сезон")
+    rebuild.set_defaults(func=command_rebuild_scores)
+
+    history = subparsers.add_parser('import_history',
+                                    help="Импортировать историю начислений из экспорта Telegram Desktop (result.json)")
+    history.add_argument('path', help="Путь к result.json")
+    history.add_argument('--chat-id', required=True, help="id чата в Bot API, например -1001234567890")
+    history.add_argument('--workers', type=int, default=4, help="Кол-во процессов разбора")
+    history.add_argument('--batch-size', type=int, default=1000, help="Сообщений в пачке разбора и строк в INSERT")
+    history.set_defaults(func=command_import_history)
+
+    bench = subparsers.add_parser('bench_parser',
+                                  help="Сравнить разбор изменений баллов с прежним по скорости и результату")
+    bench.add_argument('--size', type=int, default=100000, help="Кол-во сообщений в корпусе")
+    bench.add_argument('--seed', type=int, default=1)
+    bench.set_defaults(func=command_bench_parser)
+
+    replay = subparsers.add_parser('bench',
+                                   help="Прогнать синтетические апдейты через обработчики с фейковым ботом")
+    replay.add_argument('--updates', type=int, default=5000, help="Кол-во апдейтов в замере")
+    replay.add_argument('--chats', type=int, default=20)
+    replay.add_argument('--members', type=int, default=50, help="Участников в каждом чате")
+    replay.add_argument('--vote-ratio', type=float, default=0.2, help="Доля голосов через упоминание")
+    replay.add_argument('--multi-mention-ratio', type=float, default=0.2,
+                        help="Доля голосов с несколькими упоминаниями")
+    replay.add_argument('--reply-ratio', type=float, default=0.05, help="Доля голосов ответом на сообщение")
+    replay.add_argument('--command-ratio', type=float, default=0.05, help="Доля команд /top, /get_user_score, /help")
+    replay.add_argument('--callback-ratio', type=float, default=0.02, help="Доля нажатий кнопок меню настроек")
+    replay.add_argument('--seed', type=int, default=1)
+    replay.add_argument('--use-configured-db', action='store_true',
+                        help="Писать в базу из .env (например, локальную MySQL) вместо временной sqlite")
+    replay.set_defaults(func=command_bench)
+
+    cache_server = subparsers.add_parser('cache_server',
+                                         help="Запустить общий кэш для процессов бота (CACHE_BACKEND=shared)")
+    cache_server.add_argument('--socket', help="Путь к unix socket, по умолчанию CACHE_SOCKET")
+    cache_server.set_defaults(func=command_cache_server)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()